@@ -0,0 +1,417 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# backfill_elements.py
+
+"""
+Import a directory of historical, dated TLE files into the database. Each distinct date is registered as an epoch in
+the spacecraft_epochs table, and the elements are bulk-loaded into the spacecraft_orbits and spacecraft_orbit_epochs
+tables. Progress is checkpointed after each epoch is committed, so an interrupted backfill can be resumed by running
+the same command again.
+
+This script should not be run at the same time as <fetch_orbital_elements.py>.
+"""
+
+import argparse
+import calendar
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import satcat_fetch
+from connect_db import shared_connection, close_shared_connection, execute_many_statement
+from fetch_orbital_elements import read_mcnames, read_quicksat
+from tle_parser import parse_tle_lines, make_item, ParallelTleReader
+
+# Regular expression used to extract the date (and optionally time) of a TLE file from its filename, e.g.
+# <spacetrack_2019-03-14.tle>, <20190314.tle.gz> or <tle_20190314_1200.txt>
+filename_date_regex = re.compile(r"(\d{4})-?(\d{2})-?(\d{2})(?:[T_ -]?(\d{2}):?(\d{2}))?")
+
+# The same, without the time, used when the digits after a date are not a valid time, e.g. <20190314_25544.tle>
+filename_date_only_regex = re.compile(r"(\d{4})-?(\d{2})-?(\d{2})")
+
+# Maximum number of NORAD IDs we put into each SELECT ... IN (...) query
+lookup_batch_size = 2000
+
+
+def file_epoch(filename):
+    """
+    Extract the unix time of a dated TLE file from its filename.
+
+    :param filename:
+        The filename of the TLE file
+    :return:
+        Unix time, or None if the filename does not contain a date
+    """
+    filename = os.path.basename(filename)
+
+    # The filename may contain other runs of digits, e.g. a NORAD ID, so try every match until one is a valid date.
+    # If the digits after a date are not a valid time, try the same date on its own.
+    for start in range(len(filename)):
+        for regex in [filename_date_regex, filename_date_only_regex]:
+            test = regex.match(filename, start)
+            if not test:
+                break
+            values = [int(i) if i is not None else 0 for i in test.groups()]
+            [year, month, day, hour, minute] = values + [0] * (5 - len(values))
+            if not 1957 <= year <= 2100:
+                break
+            try:
+                date = datetime.datetime(year, month, day, hour, minute, tzinfo=datetime.timezone.utc)
+            except ValueError:
+                continue
+            return calendar.timegm(date.utctimetuple())
+    return None
+
+
+def list_dated_files(directory, logger):
+    """
+    List the dated TLE files in a directory, grouped by the epoch at which they were downloaded.
+
+    :param directory:
+        The directory to search for TLE files
+    :param logger:
+        A logging object
+    :return:
+        List of [epoch, list of file paths], sorted in chronological order
+    """
+    files_by_epoch = {}
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if not os.path.isfile(path):
+            continue
+        epoch = file_epoch(filename)
+        if epoch is None:
+            logger.info("!!! Skipping file <{}> because its name does not contain a date".format(filename))
+            continue
+        files_by_epoch.setdefault(epoch, []).append(path)
+
+    return [[epoch, files_by_epoch[epoch]] for epoch in sorted(files_by_epoch)]
+
+
+def read_checkpoint(path):
+    """
+    Read the checkpoint file listing which epochs have already been imported.
+
+    :param path:
+        The path of the checkpoint file
+    :return:
+        Dictionary of the epoch IDs of completed files, indexed by filename
+    """
+    try:
+        return json.loads(open(path).read())['completed']
+    except (ValueError, IOError, KeyError):
+        return {}
+
+
+def write_checkpoint(path, completed):
+    """
+    Atomically update the checkpoint file listing which epochs have already been imported.
+
+    :param path:
+        The path of the checkpoint file
+    :param completed:
+        Dictionary of the epoch IDs of completed files, indexed by filename
+    :return:
+        None
+    """
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps({'completed': completed}, indent=1, sort_keys=True))
+    os.replace(tmp_path, path)
+
+
+def read_dated_file(path, sat_mags, source):
+    """
+    Parse a historical TLE file, which may be gzip-compressed.
+
+    :param path:
+        The path of the TLE file we should parse
+    :param sat_mags:
+        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID
+    :param source:
+        The source ID number for these orbital elements
+    :return:
+        A list of lists containing the orbital elements we extracted from the file
+    """
+    if path.endswith(".gz"):
+        lines = gzip.open(path, "rt").readlines()
+    else:
+        lines = open(path).readlines()
+
+    return [make_item(None, record, source) for record in parse_tle_lines(lines, sat_mags, False)]
+
+
+class ParsedFile:
+    """
+    A TLE file which has already been parsed, with the same interface as a PendingTleFile.
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+    def get(self):
+        """
+        :return:
+            A list of lists containing the orbital elements in this file
+        """
+        return self.items
+
+
+def read_epoch_files(paths, parser_pool, sat_mags, source):
+    """
+    Start parsing the TLE files downloaded at a single epoch. If a pool of parser processes is available, the files
+    are parsed in the background; otherwise they are parsed immediately.
+
+    :param paths:
+        List of the paths of the TLE files
+    :param parser_pool:
+        A ParallelTleReader object, or None to parse files serially
+    :param sat_mags:
+        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID
+    :param source:
+        The source ID number for these orbital elements
+    :return:
+        List of objects with a get() method which returns the list of elements in each file
+    """
+    output = []
+    for path in paths:
+        if parser_pool:
+            output.append(parser_pool.submit(path, None, source))
+        else:
+            output.append(ParsedFile(read_dated_file(path=path, sat_mags=sat_mags, source=source)))
+    return output
+
+
+def fetch_existing_orbits(c, norad_ids, epoch_min, epoch_max):
+    """
+    Look up the orbits already in the database for a set of spacecraft, within a range of epochs.
+
+    :param c:
+        A MySQLdb database connection handle
+    :param norad_ids:
+        List of the NORAD IDs of the spacecraft to look up
+    :param epoch_min:
+        The earliest epoch of orbit to return
+    :param epoch_max:
+        The latest epoch of orbit to return
+    :return:
+        Dictionary of lists of [epoch, uid], indexed by NORAD ID
+    """
+    orbits = {}
+    for i in range(0, len(norad_ids), lookup_batch_size):
+        batch = norad_ids[i:i + lookup_batch_size]
+        c.execute("SELECT uid, noradId, epoch FROM spacecraft_orbits "
+                  "WHERE noradId IN (" + ",".join(["%s"] * len(batch)) + ") AND epoch BETWEEN %s AND %s;",
+                  list(batch) + [epoch_min, epoch_max])
+        for item in c.fetchall():
+            orbits.setdefault(item['noradId'], []).append([item['epoch'], item['uid']])
+    return orbits
+
+
+def match_orbit(orbits, norad_id, epoch):
+    """
+    Find an existing orbit for a spacecraft within one second of a given epoch, which is the tolerance
+    <main_spacecraft> uses to identify duplicate elements.
+
+    :param orbits:
+        Dictionary of lists of [epoch, uid], indexed by NORAD ID, as returned by <fetch_existing_orbits>
+    :param norad_id:
+        The NORAD ID of the spacecraft
+    :param epoch:
+        The epoch of the elements
+    :return:
+        The uid of the matching orbit, or None
+    """
+    for [orbit_epoch, uid] in orbits.get(norad_id, []):
+        if abs(orbit_epoch - epoch) <= 1:
+            return uid
+    return None
+
+
+def import_epoch(db, c, logger, epoch, items, known_spacecraft):
+    """
+    Bulk-load the orbital elements downloaded at a single historical epoch into the database.
+
+    :param db:
+        A MySQLdb database handle
+    :param c:
+        A MySQLdb database connection handle
+    :param logger:
+        A logging object
+    :param epoch:
+        The unix time at which these elements were downloaded
+    :param items:
+        A list of lists containing the orbital elements, as returned by <read_tle_file>
+    :param known_spacecraft:
+        Set of the NORAD IDs of all spacecraft in the spacecraft table
+    :return:
+        List of [epoch ID, number of elements, number of new orbits inserted]
+    """
+
+    # If an epoch already exists at this time, a previous run committed it but did not write its checkpoint
+    c.execute("SELECT uid FROM spacecraft_epochs WHERE epoch=%s;", (epoch,))
+    result = c.fetchall()
+    if result:
+        logger.info("Epoch {:d} already exists in database; skipping".format(result[0]['uid']))
+        return [result[0]['uid'], 0, 0]
+
+    # Keep only the first set of elements for each spacecraft, ignoring spacecraft which are not in SATCAT
+    elements_by_id = {}
+    for (group, norad_id, elements) in items:
+        if norad_id in known_spacecraft and norad_id not in elements_by_id:
+            elements_by_id[norad_id] = elements
+
+    norad_ids = sorted(elements_by_id)
+    if not norad_ids:
+        return [None, 0, 0]
+    epoch_min = min(elements[1] for elements in elements_by_id.values()) - 1
+    epoch_max = max(elements[1] for elements in elements_by_id.values()) + 1
+
+    c.execute("BEGIN;")
+    c.execute("INSERT INTO spacecraft_epochs (epoch) VALUES (%s);", [epoch])
+    epoch_id = db.insert_id()
+
+    # Find which of these elements are already in the database
+    existing_orbits = fetch_existing_orbits(c=c, norad_ids=norad_ids, epoch_min=epoch_min, epoch_max=epoch_max)
+    new_ids = [norad_id for norad_id in norad_ids
+               if match_orbit(existing_orbits, norad_id, elements_by_id[norad_id][1]) is None]
+
+    # Bulk insert new orbits, then look up the uids they were assigned
+    if new_ids:
+        execute_many_statement(c, 'insert_orbit', [elements_by_id[norad_id] for norad_id in new_ids])
+        existing_orbits = fetch_existing_orbits(c=c, norad_ids=norad_ids, epoch_min=epoch_min, epoch_max=epoch_max)
+
+    # Bulk insert the orbit for each spacecraft at this epoch
+    new_id_set = set(new_ids)
+    execute_many_statement(c, 'insert_orbit_epoch',
+                           [(norad_id, epoch_id,
+                             match_orbit(existing_orbits, norad_id, elements_by_id[norad_id][1]),
+                             norad_id not in new_id_set)
+                            for norad_id in norad_ids])
+
+    # Copy forward elements for spacecraft which were in the previous epoch, but missing from this one
+    satcat_fetch.duplicate_elements(logger=logger, c=c, epoch=epoch, epoch_id=epoch_id)
+
+    c.execute("COMMIT;")
+    db.commit()
+    return [epoch_id, len(norad_ids), len(new_ids)]
+
+
+def backfill(logger, directory, checkpoint_path, source, parse_processes):
+    """
+    Main entry point to import a directory of historical TLE files.
+
+    :param logger:
+        A logging object
+    :param directory:
+        The directory containing dated TLE files
+    :param checkpoint_path:
+        The path of the file in which we record which files have been imported
+    :param source:
+        The source ID number for these orbital elements
+    :param parse_processes:
+        The number of worker processes to use to parse TLE files. If zero, files are parsed serially.
+    :return:
+        None
+    """
+
+    # Make a persistent working directory
+    os.system("mkdir -p {}".format(os.path.dirname(os.path.abspath(checkpoint_path))))
+
+    # Work out which files remain to be imported
+    completed = read_checkpoint(checkpoint_path)
+    dated_files = [[epoch, paths] for [epoch, paths] in list_dated_files(directory=directory, logger=logger)
+                   if not all(os.path.basename(path) in completed for path in paths)]
+    logger.info("{:d} epochs remain to be imported ({:d} files already completed)".
+                format(len(dated_files), len(completed)))
+
+    # Use magnitudes from the most recent download of mcnames and qs.mag, if we have them
+    sat_mags = {}
+    for [path, reader] in [["../auto/tmp/spacecraft/mcnames", read_mcnames],
+                           ["../auto/tmp/spacecraft/qs.mag", read_quicksat]]:
+        if os.path.exists(path):
+            reader(path=path, sat_mags=sat_mags)
+
+    # Connect to database, with checks deferred while bulk loading
+    [db, c] = shared_connection()
+    c.max_stmt_length = 1024 * 1024
+    c.execute("SET unique_checks=0;")
+    c.execute("SET foreign_key_checks=0;")
+
+    c.execute("SELECT noradId FROM spacecraft;")
+    known_spacecraft = set(item['noradId'] for item in c.fetchall())
+
+    # If requested, parse the files for the next epoch in worker processes while we import the current one
+    parser_pool = None
+    if parse_processes:
+        parser_pool = ParallelTleReader(sat_mags=sat_mags, processes=parse_processes)
+
+    start_time = time.time()
+    total_elements = 0
+    next_files = None
+    if dated_files:
+        next_files = read_epoch_files(paths=dated_files[0][1], parser_pool=parser_pool, sat_mags=sat_mags,
+                                      source=source)
+    for index, [epoch, paths] in enumerate(dated_files):
+        current_files = next_files
+        if index + 1 < len(dated_files):
+            next_files = read_epoch_files(paths=dated_files[index + 1][1], parser_pool=parser_pool,
+                                          sat_mags=sat_mags, source=source)
+
+        items = []
+        for pending_file in current_files:
+            items.extend(pending_file.get())
+
+        [epoch_id, element_count, inserted_count] = import_epoch(db=db, c=c, logger=logger, epoch=epoch,
+                                                                 items=items, known_spacecraft=known_spacecraft)
+
+        # Record that these files are complete
+        for path in paths:
+            completed[os.path.basename(path)] = epoch_id
+        write_checkpoint(checkpoint_path, completed)
+
+        total_elements += element_count
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info("{} -- epoch {} -- {:7d} elements, {:7d} new orbits -- {:9.0f} elements per minute".
+                    format(time.strftime("%Y-%m-%d %H:%M", time.gmtime(epoch)), epoch_id, element_count,
+                           inserted_count, total_elements / elapsed * 60))
+
+    if parser_pool:
+        parser_pool.close()
+
+    # Restore normal checks and close database
+    logger.info("Cleaning up")
+    c.execute("SET unique_checks=1;")
+    c.execute("SET foreign_key_checks=1;")
+    close_shared_connection()
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        stream=sys.stdout,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory',
+                        help="Directory of TLE files, whose filenames contain the date of download, e.g. YYYYMMDD")
+    parser.add_argument('--checkpoint', dest='checkpoint', default="../auto/tmp/backfill/checkpoint.json",
+                        help="File in which to record which files have been imported")
+    parser.add_argument('--source', dest='source', type=int, default=1,
+                        help="Source ID for these elements (0 = Celestrak; 1 = space-track)")
+    parser.add_argument('--parse-processes', dest='parse_processes', type=int, default=0,
+                        help="Number of worker processes to use to parse TLE files (default: parse serially)")
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    backfill(logger=logger, directory=args.directory, checkpoint_path=args.checkpoint,
+             source=args.source, parse_processes=args.parse_processes)
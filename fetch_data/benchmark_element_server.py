@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# benchmark_element_server.py
+
+"""
+Load-test a running instance of <element_server.py>, by making repeated requests for a URL from several concurrent
+client threads, and reporting the throughput and latency.
+"""
+
+import argparse
+import http.client
+import threading
+import time
+from urllib.parse import urlparse
+
+
+def client_thread(host, port, path, headers, end_time, revalidate, latencies, statuses):
+    """
+    Make repeated requests for a URL over a single keep-alive connection until <end_time>.
+
+    :param host:
+        The hostname of the server
+    :param port:
+        The port number of the server
+    :param path:
+        The path to request
+    :param headers:
+        Dictionary of HTTP headers to send with each request
+    :param end_time:
+        The unix time at which to stop
+    :param revalidate:
+        Boolean flag indicating whether to send the ETag of the first response with subsequent requests
+    :param latencies:
+        List to which we append the latency of each request (seconds)
+    :param statuses:
+        Dictionary in which we count the number of responses with each HTTP status code
+    :return:
+        None
+    """
+    connection = http.client.HTTPConnection(host, port)
+    headers = dict(headers)
+    my_latencies = []
+    my_statuses = {}
+
+    while time.time() < end_time:
+        start = time.perf_counter()
+        connection.request("GET", path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        my_latencies.append(time.perf_counter() - start)
+        my_statuses[response.status] = my_statuses.get(response.status, 0) + 1
+
+        if revalidate and response.getheader("ETag"):
+            headers["If-None-Match"] = response.getheader("ETag")
+
+    connection.close()
+    latencies.extend(my_latencies)
+    for status, count in my_statuses.items():
+        statuses[status] = statuses.get(status, 0) + count
+
+
+def main(url, threads, duration, gzip, revalidate):
+    """
+    Main entry point for the benchmark.
+
+    :param url:
+        The URL to request
+    :param threads:
+        The number of concurrent client threads
+    :param duration:
+        The duration of the test, seconds
+    :param gzip:
+        Boolean flag indicating whether to request gzip-compressed responses
+    :param revalidate:
+        Boolean flag indicating whether to revalidate using ETags
+    :return:
+        None
+    """
+    url = urlparse(url)
+    path = (url.path or "/") + ("?" + url.query if url.query else "")
+    headers = {"Accept-Encoding": "gzip"} if gzip else {}
+    latencies = []
+    statuses = {}
+    end_time = time.time() + duration
+
+    workers = [threading.Thread(target=client_thread,
+                                kwargs={'host': url.hostname, 'port': url.port or 80, 'path': path,
+                                        'headers': headers, 'end_time': end_time, 'revalidate': revalidate,
+                                        'latencies': latencies, 'statuses': statuses})
+               for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    if not latencies:
+        print("No requests completed")
+        return
+
+    latencies.sort()
+    print("Requests:      {:d} in {:.1f} sec -- {:.1f} requests per second".
+          format(len(latencies), elapsed, len(latencies) / elapsed))
+    print("Status codes:  {}".format(", ".join("{}: {:d}".format(status, count)
+                                              for status, count in sorted(statuses.items()))))
+    for percentile in [50, 90, 99]:
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        print("Latency p{:02d}:   {:8.2f} ms".format(percentile, latencies[index] * 1000))
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', dest='url', default="http://127.0.0.1:8090/elements/latest",
+                        help="URL to request")
+    parser.add_argument('--threads', dest='threads', type=int, default=8,
+                        help="Number of concurrent client threads")
+    parser.add_argument('--duration', dest='duration', type=float, default=10,
+                        help="Duration of the test (seconds)")
+    parser.add_argument('--no-gzip', dest='gzip', action='store_false',
+                        help="Request uncompressed responses")
+    parser.add_argument('--revalidate', dest='revalidate', action='store_true',
+                        help="Send If-None-Match with the ETag of the first response, as a caching client would")
+    args = parser.parse_args()
+
+    main(url=args.url, threads=args.threads, duration=args.duration, gzip=args.gzip, revalidate=args.revalidate)
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# benchmark_tle_parser.py
+
+"""
+Micro-benchmark comparing the per-element cost of parsing a large TLE file with the original parser, which called
+calendar.timegm for every set of elements, against the current parser in <tle_parser.py>.
+"""
+
+import argparse
+import calendar
+import os
+import random
+import time
+
+from tle_parser import parse_tle_lines, tle_checksum, LINE2_FORMAT
+
+
+def write_test_file(path, line_count, seed=1):
+    """
+    Write a file of synthetic TLEs, in the three-line format used by Celestrak, for use as benchmark input.
+
+    :param path:
+        The path of the file to write
+    :param line_count:
+        The number of lines of text to write
+    :param seed:
+        Seed for the random number generator
+    :return:
+        None
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for i in range(line_count // 3):
+            norad_id = rng.randint(1, 99999)
+            line1 = "1 {:05d}U 98067A   {:02d}{:012.8f}  .{:08d}  00000-0  {:05d}-{:d} 0  999".format(
+                norad_id, rng.choice([98, 99, 5, 23, 24]), rng.uniform(1, 365), rng.randint(0, 99999),
+                rng.randint(10000, 99999), rng.randint(3, 5))
+            line2 = LINE2_FORMAT.format(
+                norad_id, rng.uniform(0, 180), rng.uniform(0, 360), rng.randint(0, 9999999), rng.uniform(0, 360),
+                rng.uniform(0, 360), rng.uniform(1, 16.5), rng.randint(0, 99999))
+            f.write("SAT {:d}\n".format(i))
+            f.write("{}{:d}\n".format(line1, tle_checksum(line1)))
+            f.write("{}{:d}\n".format(line2, tle_checksum(line2)))
+
+
+def parse_tle_lines_original(lines, sat_mags, starlink):
+    """
+    The TLE parser as it was before the epoch decoding was reworked, retained here as a reference for comparison.
+
+    :param lines:
+        A list of the lines of text in a TLE file
+    :param sat_mags:
+        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID
+    :param starlink:
+        Boolean flag indicating whether these are Starlink satellites
+    :return:
+        Yields tuples of orbital elements
+    """
+    line_count = 0
+
+    while line_count < len(lines):
+        if not lines[line_count].startswith("1 "):
+            line_count += 1
+            continue
+
+        i = line_count - 1
+        norad_id = int(lines[i + 1][2: 7])
+        incl = float(lines[i + 2][8:16])
+        ecc = float("0." + lines[i + 2][26:33])
+        ra_asc = float(lines[i + 2][17:25])
+        arg_peri = float(lines[i + 2][34:42])
+        mean_anom = float(lines[i + 2][43:51])
+        mean_motion = float(lines[i + 2][52:63])
+        year = int("20" + lines[i + 1][18:20])
+        day = float(lines[i + 1][20:32])
+
+        mean_motion_dot = ((-1 if lines[i + 1][33] == "-" else 1) *
+                           float(lines[i + 1][34:43]) * 2)
+
+        mean_motion_dot_dot = ((-1 if lines[i + 1][44] == "-" else 1) *
+                               float("0." + lines[i + 1][45:50] + "E" + lines[i + 1][50:52]) * 6)
+
+        b_star = ((-1 if lines[i + 1][53] == "-" else 1) *
+                  float("0." + lines[i + 1][54:59] + "E" + lines[i + 1][59:61]))
+
+        rev_count = float(lines[i + 2][63:68])
+
+        epoch = calendar.timegm((year, 1, 1, 0, 0, 0, 0, 0, 0))
+        epoch += (day - 1) * 3600 * 24
+        if norad_id in sat_mags:
+            mag = sat_mags[norad_id]
+        elif starlink:
+            mag = 5.5
+        else:
+            mag = None
+
+        yield (norad_id, epoch, incl, ecc, ra_asc, arg_peri, mean_anom, mean_motion, mag,
+               mean_motion_dot, mean_motion_dot_dot, b_star, rev_count)
+
+        line_count += 2
+
+
+def time_parser(parser, lines, repeats):
+    """
+    Time a TLE parser, returning the best of several repeats.
+
+    :param parser:
+        The parser function to time
+    :param lines:
+        A list of the lines of text in a TLE file
+    :param repeats:
+        The number of times to repeat the measurement
+    :return:
+        List of [number of elements parsed, best time taken (seconds)]
+    """
+    sat_mags = {norad_id: 5.0 for norad_id in range(0, 100000, 7)}
+    best = None
+    element_count = 0
+    for i in range(repeats):
+        start = time.perf_counter()
+        element_count = sum(1 for record in parser(lines, sat_mags, False))
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return [element_count, best]
+
+
+def main(line_count, repeats):
+    """
+    Main entry point for the benchmark.
+
+    :param line_count:
+        The number of lines in the synthetic TLE file
+    :param repeats:
+        The number of times to repeat each measurement
+    :return:
+        None
+    """
+    tmpdir = "../auto/tmp/benchmark"
+    os.system("mkdir -p {}".format(tmpdir))
+    path = os.path.join(tmpdir, "benchmark_{:d}.tle".format(line_count))
+    if not os.path.exists(path):
+        write_test_file(path=path, line_count=line_count)
+    lines = open(path).readlines()
+
+    print("Parsing {:d} lines of TLEs (best of {:d})".format(len(lines), repeats))
+    results = []
+    for [name, parser] in [["Original parser", parse_tle_lines_original],
+                           ["Current parser", parse_tle_lines]]:
+        [element_count, duration] = time_parser(parser=parser, lines=lines, repeats=repeats)
+        results.append(duration / element_count)
+        print("{:24s} {:8d} elements in {:7.3f} sec -- {:6.3f} us per element".
+              format(name, element_count, duration, duration / element_count * 1e6))
+    print("Speed-up: {:.2f}x".format(results[0] / results[1]))
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', dest='lines', type=int, default=100000,
+                        help="Number of lines in the synthetic TLE file")
+    parser.add_argument('--repeats', dest='repeats', type=int, default=5,
+                        help="Number of times to repeat each measurement")
+    args = parser.parse_args()
+
+    main(line_count=args.lines, repeats=args.repeats)
@@ -4,6 +4,7 @@
 import os
 import re
 import sys
+import time
 # Ignore SQL warnings
 import warnings
 from os import path as os_path
@@ -32,6 +33,135 @@ db_passwd = db_login[1].strip()
 db_name = db_login[2].strip()
 
 
+# Database connection shared by all callers within this process, stored as [process ID, database handle, cursor]
+_shared_connection = None
+
+# SQL statements which are executed many times over in the inner loops of the ingestion scripts. MySQLdb does not
+# support server-side prepared statements, so we cache a copy of each template already encoded into the connection's
+# character set, which MySQLdb would otherwise redo on every call.
+statements = {
+    'spacecraft_exists':
+        "SELECT 1 FROM spacecraft WHERE noradId=%s;",
+    'orbit_epoch_exists':
+        "SELECT orbitId FROM spacecraft_orbit_epochs WHERE noradId=%s AND epochId=%s;",
+    'orbit_near_epoch':
+        "SELECT uid FROM spacecraft_orbits WHERE noradId=%s AND epoch BETWEEN (%s-1) AND (%s+1);",
+    'insert_orbit':
+        "INSERT INTO spacecraft_orbits (noradId,epoch,incl,ecc,RAasc,argPeri,meanAnom,meanMotion,mag,"
+        "meanMotionDot,meanMotionDotDot,bStar,source,revCount) "
+        "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);",
+    'insert_orbit_epoch':
+        "INSERT INTO spacecraft_orbit_epochs (noradId, epochId, orbitId, duplicate) VALUES (%s,%s,%s,%s);",
+    'insert_group_member':
+        "INSERT INTO spacecraft_leo_groupmembers (noradId, groupId) "
+        "VALUES (%s,(SELECT uid FROM spacecraft_leo_subgroups WHERE name=%s));",
+    'spacecraft_exists_by_id':
+        "SELECT noradId FROM spacecraft WHERE noradId=%s;",
+    'insert_name':
+        "INSERT INTO spacecraft_names (noradId,name,source,primaryName) VALUES (%s,%s,%s,%s);",
+}
+
+# Encoded copies of the statements above, indexed by [statement name, character encoding]
+_encoded_statements = {}
+
+# Function called with (SQL statement, duration in seconds, number of executions) after each statement is executed,
+# used when profiling. Unbuffered cursors also report the time spent fetching the rows of each statement, with zero
+# executions.
+statement_timer = None
+
+
+class TimedCursorMixin:
+    """
+    Mixin for MySQLdb cursors which reports the time taken by each statement to <statement_timer>, if it is set.
+    """
+
+    _timing = False
+
+    def execute(self, query, args=None):
+        if statement_timer is None or self._timing:
+            return super().execute(query, args)
+        self._timing = True
+        start = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            self._timing = False
+            statement_timer(query, time.perf_counter() - start, 1)
+
+    def executemany(self, query, args):
+        if statement_timer is None or self._timing:
+            return super().executemany(query, args)
+        self._timing = True
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, args)
+        finally:
+            self._timing = False
+            statement_timer(query, time.perf_counter() - start, 1)
+
+
+class TimedServerSideCursorMixin(TimedCursorMixin):
+    """
+    Mixin for unbuffered MySQLdb cursors, which transfer rows from the server as they are fetched, rather than when
+    the statement is executed. The time spent fetching rows is added to the time of the statement which produced
+    them, and reported to <statement_timer> when the rows are exhausted, the cursor is closed or the next statement
+    is executed.
+    """
+
+    _fetch_query = None
+    _fetch_time = 0.
+
+    def report_fetch_time(self):
+        if self._fetch_query is not None and statement_timer is not None:
+            statement_timer(self._fetch_query, self._fetch_time, 0)
+        self._fetch_query = None
+        self._fetch_time = 0.
+
+    def timed_fetch(self, fetch, *args):
+        if self._fetch_query is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        result = fetch(*args)
+        self._fetch_time += time.perf_counter() - start
+        if not result:
+            self.report_fetch_time()
+        return result
+
+    def execute(self, query, args=None):
+        self.report_fetch_time()
+        result = super().execute(query, args)
+        if statement_timer is not None:
+            self._fetch_query = query
+        return result
+
+    def fetchone(self):
+        return self.timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self.timed_fetch(super().fetchmany, size)
+
+    def fetchall(self):
+        result = self.timed_fetch(super().fetchall)
+        self.report_fetch_time()
+        return result
+
+    def __iter__(self):
+        # Iterate through <fetchone>, so that each row is timed
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self.report_fetch_time()
+        return super().close()
+
+
+class TimedDictCursor(TimedCursorMixin, MySQLdb.cursors.DictCursor):
+    pass
+
+
+class TimedSSDictCursor(TimedServerSideCursorMixin, MySQLdb.cursors.SSDictCursor):
+    pass
+
+
 # Open database
 def connect_db():
     """
@@ -43,7 +173,7 @@ def connect_db():
 
     global db_host, db_name, db_passwd, db_user
     db = MySQLdb.connect(host=db_host, user=db_user, passwd=db_passwd, db=db_name)
-    c = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    c = db.cursor(cursorclass=TimedDictCursor)
 
     db.set_character_set('utf8mb4')
     c.execute('SET NAMES utf8mb4;')
@@ -53,6 +183,101 @@ def connect_db():
     return [db, c]
 
 
+def shared_connection():
+    """
+    Return the MySQLdb connection which is shared by all callers within this process, opening it if necessary. If
+    the connection has dropped, a new one is opened. Callers should not close this connection; use
+    <close_shared_connection> instead.
+
+    :return:
+        List of [database handle, connection handle]
+    """
+
+    global _shared_connection
+
+    if _shared_connection is not None:
+        [pid, db, c] = _shared_connection
+
+        # Connections cannot be shared with a forked child process, which must open its own
+        if pid == os.getpid():
+            try:
+                db.ping()
+                return [db, c]
+            except MySQLdb.OperationalError:
+                pass
+
+    [db, c] = connect_db()
+    _shared_connection = [os.getpid(), db, c]
+    return [db, c]
+
+
+def close_shared_connection():
+    """
+    Close the MySQLdb connection which is shared by all callers within this process, if it is open.
+
+    :return:
+        None
+    """
+
+    global _shared_connection
+
+    if _shared_connection is not None:
+        [pid, db, c] = _shared_connection
+        if pid == os.getpid():
+            db.close()
+        _shared_connection = None
+
+
+def server_side_cursor(db):
+    """
+    Return an unbuffered cursor, which streams rows from the server as they are fetched rather than reading the
+    entire result set into memory. All rows must be fetched before the connection is used for another query.
+
+    :param db:
+        MySQLdb database handle
+    :return:
+        MySQLdb cursor, returning rows as dictionaries
+    """
+    return db.cursor(cursorclass=TimedSSDictCursor)
+
+
+def execute_statement(c, name, args):
+    """
+    Execute one of the cached SQL statement templates listed in <statements>.
+
+    :param c:
+        MySQLdb database connection.
+    :param name:
+        The name of the statement to execute
+    :param args:
+        Tuple of the arguments to substitute into the statement
+    :return:
+        None
+    """
+    encoding = c.connection.encoding
+    key = (name, encoding)
+    if key not in _encoded_statements:
+        _encoded_statements[key] = statements[name].encode(encoding)
+    c.execute(_encoded_statements[key], args)
+
+
+def execute_many_statement(c, name, args):
+    """
+    Execute one of the cached SQL statement templates listed in <statements> for each of a list of sets of
+    arguments. INSERT statements are sent to the server as multi-row inserts.
+
+    :param c:
+        MySQLdb database connection.
+    :param name:
+        The name of the statement to execute
+    :param args:
+        List of tuples of the arguments to substitute into the statement
+    :return:
+        None
+    """
+    c.executemany(statements[name], args)
+
+
 # Fetch the ID number associated with a particular data generator string ID
 def fetch_generator_key(c, gen_key):
     """
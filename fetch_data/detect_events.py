@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# detect_events.py
+
+"""
+Search the recent history of orbital elements of all spacecraft for manoeuvres and for rapidly decaying orbits, and
+record the events we find in the spacecraft_events table.
+
+Manoeuvres are flagged where consecutive sets of elements for a spacecraft show a jump in mean motion, inclination or
+eccentricity which is far larger than that spacecraft's typical epoch-to-epoch scatter. Changes in mean motion are
+measured relative to the drift expected from the first derivative of mean motion.
+
+Decaying objects are flagged where the first derivative of mean motion (or the B* drag term) is both large and
+growing over the most recent part of the history.
+
+The catalogue is divided into ranges of NORAD IDs, which are processed in parallel by a pool of worker processes.
+Each worker pulls the histories of all the spacecraft in its range in a single query, and analyses them all at once
+with NumPy.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+from connect_db import shared_connection, close_shared_connection, server_side_cursor
+
+# The fields we pull from the spacecraft_orbits table
+history_fields = ["noradId", "epoch", "incl", "ecc", "meanMotion", "meanMotionDot", "bStar"]
+
+# Settings for the detection of manoeuvres. For each parameter, a jump is flagged if it exceeds <threshold> times the
+# spacecraft's robust scatter in that parameter, and is also larger than the given floor value.
+manoeuvre_parameters = [
+    # [parameter, floor]
+    ["meanMotion", 2e-4],  # rev/day
+    ["incl", 5e-3],  # degrees
+    ["ecc", 5e-5],
+]
+
+# Settings for the detection of decay
+decay_parameters = [
+    # [parameter, minimum value of parameter at the latest epoch]
+    ["meanMotionDot", 5e-4],  # rev/day^2
+    ["bStar", 1e-3],  # 1/earth radii
+]
+
+
+def fetch_histories(norad_min, norad_max, epoch_min):
+    """
+    Pull the histories of orbital elements of a range of spacecraft from the database.
+
+    :param norad_min:
+        The lowest NORAD ID to fetch
+    :param norad_max:
+        The highest NORAD ID to fetch
+    :param epoch_min:
+        The unix time of the earliest elements to fetch
+    :return:
+        Dictionary of NumPy arrays, indexed by field name, sorted by NORAD ID and then epoch
+    """
+    [db, c] = shared_connection()
+    cursor = server_side_cursor(db)
+    cursor.execute("SELECT " + ",".join(history_fields) + " FROM spacecraft_orbits "
+                   "WHERE noradId BETWEEN %s AND %s AND epoch>=%s ORDER BY noradId, epoch;",
+                   (norad_min, norad_max, epoch_min))
+    rows = cursor.fetchall()
+    cursor.close()
+
+    # NULL values become NaN
+    return {field: np.array([row[field] for row in rows], dtype=np.float64) for field in history_fields}
+
+
+def group_median(values, groups, group_count):
+    """
+    Compute the median of the values in each of a number of groups, ignoring NaNs.
+
+    :param values:
+        NumPy array of values
+    :param groups:
+        NumPy array of the integer group index (0 to group_count-1) of each value
+    :param group_count:
+        The number of groups
+    :return:
+        NumPy array of the median of each group, which is NaN for groups with no values
+    """
+    valid = ~np.isnan(values)
+    values = values[valid]
+    groups = groups[valid]
+
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=group_count)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    medians = np.full(group_count, np.nan)
+    has_values = counts > 0
+    lower = starts[has_values] + (counts[has_values] - 1) // 2
+    upper = starts[has_values] + counts[has_values] // 2
+    medians[has_values] = (sorted_values[lower] + sorted_values[upper]) / 2
+    return medians
+
+
+def detect_manoeuvres(history, group, first_in_group, threshold, maximum_gap_days):
+    """
+    Flag jumps in orbital elements between consecutive epochs, across all spacecraft at once.
+
+    :param history:
+        Dictionary of NumPy arrays, indexed by field name, sorted by NORAD ID and then epoch
+    :param group:
+        NumPy array of the index of the spacecraft that each row belongs to
+    :param first_in_group:
+        NumPy boolean array, which is true for the first row of each spacecraft
+    :param threshold:
+        The number of times the robust scatter by which a jump must exceed
+    :param maximum_gap_days:
+        Jumps across gaps in the data longer than this are ignored
+    :return:
+        List of tuples of (noradId, epoch, eventType, parameter, value, score)
+    """
+    group_count = int(group[-1]) + 1
+
+    # Pairs of consecutive epochs for the same spacecraft
+    dt_days = np.diff(history['epoch']) / 86400
+    pair_valid = ~first_in_group[1:] & (dt_days > 0) & (dt_days <= maximum_gap_days)
+    pair_group = group[1:]
+
+    events = []
+    for [parameter, floor] in manoeuvre_parameters:
+        change = np.diff(history[parameter])
+
+        # Subtract the change in mean motion expected from its first derivative, averaged over the interval
+        if parameter == "meanMotion":
+            mean_motion_dot = np.nan_to_num(history['meanMotionDot'])
+            change = change - (mean_motion_dot[:-1] + mean_motion_dot[1:]) / 2 * dt_days
+
+        change[~pair_valid] = np.nan
+
+        # Robust estimate of the scatter of each spacecraft's epoch-to-epoch changes: 1.4826 x median absolute
+        # deviation
+        median = group_median(change, pair_group, group_count)
+        deviation = np.abs(change - median[pair_group])
+        scatter = 1.4826 * group_median(deviation, pair_group, group_count)
+        scatter = np.maximum(np.nan_to_num(scatter), floor / threshold)[pair_group]
+
+        with np.errstate(invalid='ignore'):
+            score = deviation / scatter
+            flagged = np.nonzero(score > threshold)[0]
+
+        for i in flagged:
+            events.append((int(history['noradId'][i + 1]), float(history['epoch'][i + 1]), "manoeuvre", parameter,
+                           float(change[i]), float(score[i])))
+
+    return events
+
+
+def detect_decay(history, group, last_in_group, trend_days):
+    """
+    Flag spacecraft whose orbits are decaying rapidly, across all spacecraft at once. We fit a linear trend to each
+    decay parameter over the most recent <trend_days> of each spacecraft's history.
+
+    :param history:
+        Dictionary of NumPy arrays, indexed by field name, sorted by NORAD ID and then epoch
+    :param group:
+        NumPy array of the index of the spacecraft that each row belongs to
+    :param last_in_group:
+        NumPy boolean array, which is true for the last row of each spacecraft
+    :param trend_days:
+        The length of the window over which we fit the trend, days
+    :return:
+        List of tuples of (noradId, epoch, eventType, parameter, value, score)
+    """
+    group_count = int(group[-1]) + 1
+    last_rows = np.nonzero(last_in_group)[0]
+    last_epoch = history['epoch'][last_rows]
+
+    # Time of each row relative to the spacecraft's latest epoch, in days
+    t = (history['epoch'] - last_epoch[group]) / 86400
+
+    events = []
+    for [parameter, minimum_value] in decay_parameters:
+        y = history[parameter]
+        use = (t >= -trend_days) & ~np.isnan(y)
+        weights = use.astype(np.float64)
+        t_use = np.where(use, t, 0)
+        y_use = np.where(use, y, 0)
+
+        # Least-squares slope of y against t for each spacecraft, from sums accumulated with bincount
+        n = np.bincount(group, weights=weights, minlength=group_count)
+        sum_t = np.bincount(group, weights=t_use, minlength=group_count)
+        sum_y = np.bincount(group, weights=y_use, minlength=group_count)
+        sum_tt = np.bincount(group, weights=t_use * t_use, minlength=group_count)
+        sum_ty = np.bincount(group, weights=t_use * y_use, minlength=group_count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            denominator = n * sum_tt - sum_t * sum_t
+            slope = np.where(denominator > 0, (n * sum_ty - sum_t * sum_y) / denominator, np.nan)
+
+        latest_value = y[last_rows]
+        with np.errstate(invalid='ignore'):
+            flagged = np.nonzero((n >= 3) & (slope > 0) & (latest_value >= minimum_value))[0]
+
+        for g in flagged:
+            i = last_rows[g]
+            events.append((int(history['noradId'][i]), float(history['epoch'][i]), "decay", parameter,
+                           float(latest_value[g]), float(slope[g])))
+
+    return events
+
+
+def analyse_range(task):
+    """
+    Search a range of NORAD IDs for events, and write them to the database. This runs in a worker process.
+
+    :param task:
+        List of [lowest NORAD ID, highest NORAD ID, earliest epoch to analyse, threshold, maximum gap (days),
+        trend window (days)]
+    :return:
+        List of [number of spacecraft analysed, number of sets of elements analysed, number of events found]
+    """
+    [norad_min, norad_max, epoch_min, threshold, maximum_gap_days, trend_days] = task
+
+    history = fetch_histories(norad_min=norad_min, norad_max=norad_max, epoch_min=epoch_min)
+    row_count = len(history['epoch'])
+    if row_count == 0:
+        return [0, 0, 0]
+
+    # Index the spacecraft within this range, and mark the first and last row of each
+    new_spacecraft = np.concatenate([[True], np.diff(history['noradId']) != 0])
+    group = np.cumsum(new_spacecraft) - 1
+    last_in_group = np.concatenate([new_spacecraft[1:], [True]])
+
+    events = (detect_manoeuvres(history=history, group=group, first_in_group=new_spacecraft,
+                                threshold=threshold, maximum_gap_days=maximum_gap_days) +
+              detect_decay(history=history, group=group, last_in_group=last_in_group, trend_days=trend_days))
+
+    # Record events. Events found by previous runs are left unchanged.
+    if events:
+        [db, c] = shared_connection()
+        c.executemany("INSERT IGNORE INTO spacecraft_events "
+                      "(noradId, epoch, eventType, parameter, value, score) "
+                      "VALUES (%s,%s,%s,%s,%s,%s);", events)
+        db.commit()
+
+    return [int(group[-1]) + 1, row_count, len(events)]
+
+
+def detect_events(logger, days, processes, range_size, threshold, maximum_gap_days, trend_days):
+    """
+    Main entry point to search for manoeuvres and decaying orbits.
+
+    :param logger:
+        A logging object
+    :param days:
+        The number of days of history to analyse
+    :param processes:
+        The number of worker processes to use
+    :param range_size:
+        The number of NORAD IDs in each range processed by a worker
+    :param threshold:
+        The number of times the robust scatter by which a jump must exceed to be flagged as a manoeuvre
+    :param maximum_gap_days:
+        Jumps across gaps in the data longer than this are ignored
+    :param trend_days:
+        The length of the window over which we fit trends to decay parameters, days
+    :return:
+        None
+    """
+    [db, c] = shared_connection()
+    c.execute("SELECT COALESCE(MAX(noradId), 0) AS maxId FROM spacecraft;")
+    max_norad_id = c.fetchone()['maxId']
+
+    # Don't share our database connection with the worker processes
+    close_shared_connection()
+
+    epoch_min = time.time() - days * 86400
+    tasks = [[norad_min, norad_min + range_size - 1, epoch_min, threshold, maximum_gap_days, trend_days]
+             for norad_min in range(0, max_norad_id + 1, range_size)]
+    logger.info("Analysing {:d} days of elements in {:d} ranges of NORAD IDs".format(days, len(tasks)))
+
+    with multiprocessing.Pool(processes=processes) as pool:
+        results = pool.map(analyse_range, tasks)
+
+    logger.info("Analysed {:d} sets of elements for {:d} spacecraft".
+                format(sum(result[1] for result in results), sum(result[0] for result in results)))
+    logger.info("Found {:d} events".format(sum(result[2] for result in results)))
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        stream=sys.stdout,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', dest='days', type=int, default=90,
+                        help="Number of days of history to analyse")
+    parser.add_argument('--processes', dest='processes', type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--range-size', dest='range_size', type=int, default=5000,
+                        help="Number of NORAD IDs processed by each task")
+    parser.add_argument('--threshold', dest='threshold', type=float, default=8,
+                        help="Size of jump, relative to robust scatter, needed to flag a manoeuvre")
+    parser.add_argument('--maximum-gap', dest='maximum_gap_days', type=float, default=10,
+                        help="Ignore jumps across gaps in the data longer than this (days)")
+    parser.add_argument('--trend-days', dest='trend_days', type=float, default=14,
+                        help="Window over which trends in decay parameters are fitted (days)")
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip().split("\n\n")[0])
+
+    detect_events(logger=logger, days=args.days, processes=args.processes, range_size=args.range_size,
+                  threshold=args.threshold, maximum_gap_days=args.maximum_gap_days, trend_days=args.trend_days)
@@ -0,0 +1,660 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# element_server.py
+
+"""
+A small read-only HTTP service which serves orbital elements, spacecraft names and group listings from the database
+as JSON, so that downstream systems do not need to query MySQL directly.
+
+Endpoints:
+    /elements/latest                    -- elements of all spacecraft at the most recent epoch
+    /epochs/<epochId>/elements          -- elements of all spacecraft at a past epoch
+    /spacecraft/<noradId>/elements      -- history of elements for one spacecraft (optional ?start=&end= unix times)
+    /spacecraft/<noradId>/names         -- all names of one spacecraft
+    /groups                             -- list of all groups and subgroups of spacecraft
+    /groups/<subgroup>/members          -- list of the NORAD IDs of the spacecraft in a subgroup
+    /names?q=<name>                     -- search for spacecraft by name
+    /tle/<epochId or latest>/<file>     -- TLE file for a subgroup of spacecraft, e.g. /tle/latest/starlink.tle
+
+Whole-epoch responses are serialised and compressed once per epoch. All responses carry an ETag, so clients can
+revalidate with If-None-Match and receive a 304 response if nothing has changed. Gzip-compressed responses have their
+own ETags, ending in -gz.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+import MySQLdb
+
+import tle_export
+from connect_db import connect_db, shared_connection, server_side_cursor
+
+# The columns of spacecraft_orbits which we return, in the order they appear in each row of a response
+element_fields = ["noradId", "epoch", "incl", "ecc", "RAasc", "argPeri", "meanAnom", "meanMotion",
+                  "meanMotionDot", "meanMotionDotDot", "bStar", "mag", "revCount", "source"]
+
+# MySQLdb connections cannot be used by several threads at once, so database queries are serialised with this lock
+database_lock = threading.Lock()
+
+# Lock used to ensure that only one thread at a time renders TLE files for a historical epoch
+tle_export_lock = threading.Lock()
+
+# Lock used to ensure that only one thread at a time queries the elements of a whole epoch
+epoch_build_lock = threading.Lock()
+
+# Rendering the TLE files for a historical epoch, or querying the elements of a whole epoch, takes several seconds.
+# Each of these tasks uses its own database connection, indexed by name, and does not hold <database_lock>. The
+# "render" connection is only used while holding <tle_export_lock>, and the "epoch" connection while holding
+# <epoch_build_lock>.
+_dedicated_connections = {}
+
+
+def read_connection():
+    """
+    Return the database connection shared by this process, in autocommit mode. Otherwise the connection would hold
+    open a single transaction, and never see epochs committed after the server started.
+
+    :return:
+        List of [database handle, connection handle]
+    """
+    [db, c] = shared_connection()
+    db.autocommit(True)
+    return [db, c]
+
+
+def dedicated_connection(name):
+    """
+    Return the database connection used for a slow task, in autocommit mode, opening it if necessary. If the
+    connection has dropped, a new one is opened.
+
+    :param name:
+        The name of the task, either "render" or "epoch"
+    :return:
+        List of [database handle, connection handle]
+    """
+    if name in _dedicated_connections:
+        [db, c] = _dedicated_connections[name]
+        try:
+            db.ping()
+            return [db, c]
+        except MySQLdb.OperationalError:
+            pass
+
+    [db, c] = connect_db()
+    db.autocommit(True)
+    _dedicated_connections[name] = [db, c]
+    return [db, c]
+
+
+class Response:
+    """
+    A pre-serialised JSON response body, held both uncompressed and gzip-compressed, together with their ETags. Each
+    content-coding is a different representation, so each needs its own strong ETag.
+    """
+
+    def __init__(self, data, etag=None):
+        """
+        Serialise a response.
+
+        :param data:
+            The data structure to serialise as JSON
+        :param etag:
+            The ETag for this response. If None, a hash of the response body is used.
+        """
+        self.body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        self.body_gzip = gzip.compress(self.body, compresslevel=6)
+        if etag is None:
+            etag = hashlib.sha1(self.body).hexdigest()
+        self.etag = '"{}"'.format(etag)
+        self.etag_gzip = '"{}-gz"'.format(etag)
+        self.content_type = "application/json"
+        self.has_gzip = True
+
+    def read(self, use_gzip):
+        """
+        Return the body of this response.
+
+        :param use_gzip:
+            Boolean flag indicating whether to return the gzip-compressed body
+        :return:
+            Bytes object
+        """
+        return self.body_gzip if use_gzip else self.body
+
+
+class FileResponse:
+    """
+    A response whose body is a file on disk, optionally with a gzip-compressed copy alongside it with the suffix .gz.
+    This has the same interface as a Response object.
+    """
+
+    def __init__(self, path, etag, content_type):
+        """
+        :param path:
+            The path of the file
+        :param etag:
+            The ETag for this response
+        :param content_type:
+            The MIME type of the file
+        """
+        self.path = path
+        self.etag = '"{}"'.format(etag)
+        self.etag_gzip = '"{}-gz"'.format(etag)
+        self.content_type = content_type
+        self.has_gzip = os.path.exists("{}.gz".format(path))
+
+    def read(self, use_gzip):
+        """
+        Return the body of this response.
+
+        :param use_gzip:
+            Boolean flag indicating whether to return the gzip-compressed body
+        :return:
+            Bytes object
+        """
+        with open("{}.gz".format(self.path) if use_gzip else self.path, "rb") as f:
+            return f.read()
+
+
+class EpochSnapshotCache:
+    """
+    Cache of the pre-serialised whole-epoch responses. We poll the spacecraft_epochs table at most once every
+    <poll_interval> seconds to see whether a new epoch has been committed. When one has, its response is built in a
+    background thread, and the previous epoch continues to be served as the latest until it is ready.
+    """
+
+    def __init__(self, poll_interval=10, max_epochs=8):
+        """
+        :param poll_interval:
+            The minimum interval between checks for a new epoch, seconds
+        :param max_epochs:
+            The maximum number of past epochs to hold in memory
+        """
+        self.poll_interval = poll_interval
+        self.max_epochs = max_epochs
+        self.lock = threading.Lock()
+        self.latest_epoch_id = None
+        self.pending_epoch_id = None
+        self.last_poll = 0
+        self.snapshots = OrderedDict()
+
+        # Locks held while building the response for each epoch, so that each is only built once
+        self.build_locks = {}
+
+    def latest(self):
+        """
+        Return the response for the most recent epoch.
+
+        :return:
+            Response object, or None if the database contains no epochs
+        """
+        with self.lock:
+            poll = time.time() > self.last_poll + self.poll_interval
+            if poll:
+                self.last_poll = time.time()
+
+        if poll:
+            with database_lock:
+                [db, c] = read_connection()
+                c.execute("SELECT uid FROM spacecraft_epochs ORDER BY epoch DESC LIMIT 1;")
+                result = c.fetchall()
+            epoch_id = result[0]['uid'] if result else None
+
+            with self.lock:
+                start_build = epoch_id not in [self.latest_epoch_id, self.pending_epoch_id]
+                if start_build:
+                    self.pending_epoch_id = epoch_id
+
+            if start_build:
+                if self.latest_epoch_id is None:
+                    # Nothing to serve in the meantime, so build the response for this epoch straight away
+                    self.prebuild(epoch_id)
+                else:
+                    threading.Thread(target=self.prebuild, args=(epoch_id,), daemon=True).start()
+
+        epoch_id = self.latest_epoch_id
+        if epoch_id is None:
+            return None
+        return self.epoch(epoch_id)
+
+    def prebuild(self, epoch_id):
+        """
+        Build the response for a newly committed epoch, and then start serving it as the latest epoch.
+
+        :param epoch_id:
+            The database ID of the epoch
+        :return:
+            None
+        """
+        try:
+            if epoch_id is None or self.epoch(epoch_id) is not None:
+                self.latest_epoch_id = epoch_id
+        except Exception:
+            logging.exception("Error building response for epoch {}".format(epoch_id))
+        finally:
+            # If the build failed, try again at the next poll
+            with self.lock:
+                self.pending_epoch_id = None
+
+    def epoch(self, epoch_id):
+        """
+        Return the response for a particular epoch, building it if it is not already cached. The cache is not locked
+        while a response is being built, so requests for other epochs are not held up.
+
+        :param epoch_id:
+            The database ID of the epoch
+        :return:
+            Response object, or None if this epoch does not exist
+        """
+        with self.lock:
+            if epoch_id in self.snapshots:
+                self.snapshots.move_to_end(epoch_id)
+                return self.snapshots[epoch_id]
+            build_lock = self.build_locks.setdefault(epoch_id, threading.Lock())
+
+        with build_lock:
+            # Another thread may have built this response while we waited for the lock
+            with self.lock:
+                if epoch_id in self.snapshots:
+                    return self.snapshots[epoch_id]
+
+            response = build_epoch_response(epoch_id)
+
+            with self.lock:
+                if response is not None:
+                    self.snapshots[epoch_id] = response
+                    while len(self.snapshots) > self.max_epochs:
+                        self.snapshots.popitem(last=False)
+                self.build_locks.pop(epoch_id, None)
+            return response
+
+
+def build_epoch_response(epoch_id):
+    """
+    Query the elements of all spacecraft at a particular epoch, and serialise them.
+
+    :param epoch_id:
+        The database ID of the epoch
+    :return:
+        Response object, or None if this epoch does not exist
+    """
+    with epoch_build_lock:
+        [db, c] = dedicated_connection("epoch")
+        c.execute("SELECT epoch FROM spacecraft_epochs WHERE uid=%s;", (epoch_id,))
+        result = c.fetchall()
+        if not result:
+            return None
+        epoch = result[0]['epoch']
+
+        # Stream the elements with an unbuffered cursor, since this is a large result set
+        cursor = server_side_cursor(db)
+        cursor.execute("SELECT " + ",".join("o." + field for field in element_fields) + ", oe.duplicate "
+                       "FROM spacecraft_orbit_epochs oe "
+                       "INNER JOIN spacecraft_orbits o ON o.uid=oe.orbitId "
+                       "WHERE oe.epochId=%s ORDER BY oe.noradId;", (epoch_id,))
+        elements = [[item[field] for field in element_fields] + [bool(item['duplicate'])] for item in cursor]
+        cursor.close()
+
+    return Response(data={'epochId': epoch_id,
+                          'epoch': epoch,
+                          'fields': element_fields + ['duplicate'],
+                          'elements': elements},
+                    etag="epoch-{:d}".format(epoch_id))
+
+
+def query(sql, args=()):
+    """
+    Run an SQL query against the database.
+
+    :param sql:
+        The SQL query
+    :param args:
+        The arguments to substitute into the query
+    :return:
+        List of dictionaries of results
+    """
+    with database_lock:
+        [db, c] = read_connection()
+        c.execute(sql, args)
+        return c.fetchall()
+
+
+def spacecraft_elements(norad_id, start=None, end=None):
+    """
+    Build the response listing the history of orbital elements of a single spacecraft.
+
+    :param norad_id:
+        The NORAD ID of the spacecraft
+    :param start:
+        Optional unix time of the earliest elements to return
+    :param end:
+        Optional unix time of the latest elements to return
+    :return:
+        Response object
+    """
+    result = query("SELECT " + ",".join(element_fields) + " FROM spacecraft_orbits "
+                   "WHERE noradId=%s AND epoch BETWEEN %s AND %s ORDER BY epoch;",
+                   (norad_id, start if start is not None else 0, end if end is not None else 1e12))
+    return Response(data={'noradId': norad_id,
+                          'fields': element_fields,
+                          'elements': [[item[field] for field in element_fields] for item in result]})
+
+
+def spacecraft_names(norad_id):
+    """
+    Build the response listing all the names of a single spacecraft.
+
+    :param norad_id:
+        The NORAD ID of the spacecraft
+    :return:
+        Response object
+    """
+    result = query("SELECT name, primaryName, source FROM spacecraft_names WHERE noradId=%s "
+                   "ORDER BY primaryName DESC, name;", (norad_id,))
+    return Response(data={'noradId': norad_id,
+                          'names': [{'name': item['name'],
+                                     'primary': bool(item['primaryName']),
+                                     'source': item['source']} for item in result]})
+
+
+def group_list():
+    """
+    Build the response listing all groups and subgroups of spacecraft.
+
+    :return:
+        Response object
+    """
+    result = query("SELECT g.name AS groupname, s.name AS subgroupname, "
+                   "(SELECT COUNT(*) FROM spacecraft_leo_groupmembers m WHERE m.groupId=s.uid) AS members "
+                   "FROM spacecraft_leo_subgroups s "
+                   "INNER JOIN spacecraft_leo_groups g ON s.parent=g.uid "
+                   "ORDER BY g.name, s.name;")
+    groups = OrderedDict()
+    for item in result:
+        groups.setdefault(item['groupname'], []).append({'name': item['subgroupname'],
+                                                         'members': item['members']})
+    return Response(data={'groups': [{'name': name, 'subgroups': subgroups} for name, subgroups in groups.items()]})
+
+
+def group_members(subgroup):
+    """
+    Build the response listing the spacecraft in a subgroup.
+
+    :param subgroup:
+        The name of the subgroup
+    :return:
+        Response object, or None if the subgroup does not exist
+    """
+    if not query("SELECT 1 FROM spacecraft_leo_subgroups WHERE name=%s;", (subgroup,)):
+        return None
+    result = query("SELECT m.noradId FROM spacecraft_leo_groupmembers m "
+                   "INNER JOIN spacecraft_leo_subgroups s ON m.groupId=s.uid "
+                   "WHERE s.name=%s ORDER BY m.noradId;", (subgroup,))
+    return Response(data={'subgroup': subgroup,
+                          'noradIds': [item['noradId'] for item in result]})
+
+
+def name_search(name, limit=100):
+    """
+    Build the response listing spacecraft whose names begin with a search string.
+
+    :param name:
+        The search string
+    :param limit:
+        The maximum number of matches to return
+    :return:
+        Response object
+    """
+    pattern = name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    result = query("SELECT n.noradId, n.name, "
+                   "(SELECT p.name FROM spacecraft_names p WHERE p.noradId=n.noradId AND p.primaryName "
+                   " LIMIT 1) AS primaryName "
+                   "FROM spacecraft_names n WHERE n.name LIKE %s ORDER BY n.noradId LIMIT %s;",
+                   (pattern, limit))
+    return Response(data={'query': name,
+                          'matches': [{'noradId': item['noradId'],
+                                       'name': item['name'],
+                                       'primaryName': item['primaryName']} for item in result]})
+
+
+def tle_file(epoch, filename):
+    """
+    Build the response containing a pre-rendered TLE file, rendering it first if it is for a historical epoch we have
+    not rendered yet.
+
+    :param epoch:
+        The ID of the epoch, or "latest"
+    :param filename:
+        The name of the TLE file
+    :return:
+        FileResponse object, or None if the file does not exist
+    """
+    if epoch == "latest":
+        epoch_id = tle_export.latest_epoch_id()
+        path = os.path.join(tle_export.epoch_directory(epoch_id), filename) if epoch_id is not None else None
+    else:
+        epoch_id = int(epoch)
+        with tle_export_lock:
+            [db, c] = dedicated_connection("render")
+            path = tle_export.get_tle_file(logger=logging.getLogger(__name__), epoch_id=epoch_id, filename=filename,
+                                           db=db, c=c)
+
+    if path is None or not os.path.exists(path):
+        return None
+
+    # Past epochs are rendered with the current group memberships, so the contents of a file can change when an epoch
+    # is rendered again. Each rendering is written into a uniquely named directory, whose name forms part of the ETag.
+    render_dir = os.path.basename(os.path.realpath(os.path.dirname(path)))
+    return FileResponse(path=path, etag="tle-{}-{}".format(render_dir, filename),
+                        content_type="text/plain; charset=utf-8")
+
+
+class ElementRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler for HTTP requests to the element server.
+    """
+
+    # Keep connections alive, so that clients can make many requests cheaply. Headers and body are written
+    # separately, so disable Nagle's algorithm to avoid waiting for a delayed ACK between them.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    # Cache of whole-epoch responses, shared by all handler threads
+    snapshot_cache = EpochSnapshotCache()
+
+    def do_GET(self):
+        """
+        Respond to a GET request.
+
+        :return:
+            None
+        """
+        url = urlparse(self.path)
+        path = unquote(url.path).rstrip("/")
+        params = parse_qs(url.query)
+
+        try:
+            response = self.route(path, params)
+
+            # Read the body before sending anything, so that errors can still be reported to the client
+            if response is not None:
+                use_gzip = response.has_gzip and "gzip" in self.headers.get("Accept-Encoding", "")
+                etag = response.etag_gzip if use_gzip else response.etag
+                modified = not self.not_modified([response.etag, response.etag_gzip])
+                body = response.read(use_gzip) if modified else None
+        except ValueError:
+            self.send_error(400, "Bad request")
+            return
+        except Exception:
+            logging.exception("Error serving <{}>".format(self.path))
+            self.send_error(500, "Internal server error")
+            return
+
+        if response is None:
+            self.send_error(404, "Not found")
+        elif body is None:
+            self.send_not_modified(etag)
+        else:
+            self.send_body(content_type=response.content_type, etag=etag, use_gzip=use_gzip, body=body)
+
+    def route(self, path, params):
+        """
+        Build the response to a request.
+
+        :param path:
+            The path component of the requested URL
+        :param params:
+            Dictionary of query parameters
+        :return:
+            Response or FileResponse object, or None if the URL is not recognised
+        """
+        if path == "/elements/latest":
+            return self.snapshot_cache.latest()
+
+        test = re.match(r"/epochs/(\d+)/elements$", path)
+        if test:
+            return self.snapshot_cache.epoch(int(test.group(1)))
+
+        test = re.match(r"/spacecraft/(\d+)/elements$", path)
+        if test:
+            start = float(params['start'][0]) if 'start' in params else None
+            end = float(params['end'][0]) if 'end' in params else None
+            return spacecraft_elements(norad_id=int(test.group(1)), start=start, end=end)
+
+        test = re.match(r"/spacecraft/(\d+)/names$", path)
+        if test:
+            return spacecraft_names(norad_id=int(test.group(1)))
+
+        if path == "/groups":
+            return group_list()
+
+        test = re.match(r"/groups/([^/]+)/members$", path)
+        if test:
+            return group_members(subgroup=test.group(1))
+
+        if path == "/names" and 'q' in params:
+            return name_search(name=params['q'][0])
+
+        test = re.match(r"/tle/(latest|\d+)/([\w.-]+\.tle)$", path)
+        if test:
+            return tle_file(epoch=test.group(1), filename=test.group(2))
+
+        return None
+
+    def send_body(self, content_type, etag, use_gzip, body):
+        """
+        Send the body of a response.
+
+        :param content_type:
+            The MIME type of the response
+        :param etag:
+            The ETag of the response
+        :param use_gzip:
+            Boolean flag indicating whether the body is gzip-compressed
+        :param body:
+            Bytes object containing the body
+        :return:
+            None
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, etags):
+        """
+        Test whether the client already holds any representation of a resource, according to its If-None-Match
+        header. If-None-Match uses the weak comparison function, so weak tags (W/"...") also match.
+
+        :param etags:
+            List of the ETags of all the representations of the resource
+        :return:
+            Boolean
+        """
+        tags = [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+        return "*" in tags or any(etag in tags for etag in etags)
+
+    def send_not_modified(self, etag):
+        """
+        Send a 304 response, telling the client that its cached copy of a resource is still valid.
+
+        :param etag:
+            The ETag of the representation the client would otherwise have been sent
+        :return:
+            None
+        """
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve(logger, host, port, poll_interval):
+    """
+    Main entry point for the element server.
+
+    :param logger:
+        A logging object
+    :param host:
+        The hostname or IP address to listen on
+    :param port:
+        The port number to listen on
+    :param poll_interval:
+        The minimum interval between checks for a new epoch, seconds
+    :return:
+        None
+    """
+    ElementRequestHandler.snapshot_cache.poll_interval = poll_interval
+    server = ThreadingHTTPServer((host, port), ElementRequestHandler)
+
+    # Build the response for the latest epoch before the first client asks for it
+    ElementRequestHandler.snapshot_cache.latest()
+    logger.info("Serving orbital elements on http://{}:{:d}/".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        stream=sys.stdout,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', dest='host', default="127.0.0.1",
+                        help="Hostname or IP address to listen on")
+    parser.add_argument('--port', dest='port', type=int, default=8090,
+                        help="Port number to listen on")
+    parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=10,
+                        help="Minimum interval between checks for a new epoch (seconds)")
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+    serve(logger=logger, host=args.host, port=args.port, poll_interval=args.poll_interval)
@@ -0,0 +1,575 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# element_store.py
+
+"""
+A compact on-disk store of the history of orbital elements of each spacecraft, which can be read back into NumPy
+arrays far more quickly than querying the spacecraft_orbits table.
+
+Each spacecraft's elements are held in a single file, sorted by epoch and divided into blocks. Within each block,
+fields which have a fixed number of decimal places in TLEs are quantized to integers and delta-encoded, using the
+narrowest integer type which fits the deltas. Other fields are stored losslessly, by XOR-ing the bit pattern of each
+value with the previous one. Each block is then zlib-compressed.
+
+Usage:
+    ./element_store.py build            -- build the store from scratch from the spacecraft_orbits table
+    ./element_store.py update           -- add orbits inserted since the store was last built or updated
+    ./element_store.py report           -- compare the size and read speed of the store against SQL
+"""
+
+import argparse
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+
+import numpy as np
+
+from connect_db import shared_connection, close_shared_connection, server_side_cursor
+
+# The fields we store for each set of elements, and the number of decimal places to which each is quantized. Fields
+# with None are stored losslessly. Epochs are quantized to the nearest microsecond, far finer than the resolution of
+# a TLE epoch (1e-8 day). Other quantized fields are stored to the number of decimal places in a TLE, and are
+# recovered exactly.
+store_fields = [
+    ["epoch", 6],
+    ["incl", 4],
+    ["ecc", 7],
+    ["RAasc", 4],
+    ["argPeri", 4],
+    ["meanAnom", 4],
+    ["meanMotion", 8],
+    ["meanMotionDot", 8],
+    ["meanMotionDotDot", None],
+    ["bStar", None],
+    ["mag", None],
+    ["revCount", 0],
+    ["source", 0],
+]
+
+field_names = [name for [name, decimals] in store_fields]
+
+# The maximum number of sets of elements in each block
+block_length = 1024
+
+# Sets of elements for the same spacecraft whose epochs are within this many seconds of each other are duplicates
+duplicate_tolerance = 1e-3
+
+# Orbits are not necessarily committed in order of uid, e.g. if a backfill runs at the same time as a fetch, so an
+# update re-reads this many orbits below the last uid it stored. Those which are already stored are discarded.
+update_uid_margin = 100000
+
+# Magic number at the start of each file
+file_magic = b"ELS1"
+
+# Each block begins with (number of records, earliest epoch, latest epoch, length of compressed payload)
+block_header = struct.Struct("<IddI")
+
+# Each field within a block's payload begins with (encoding, integer width in bytes, first quantized value)
+field_header = struct.Struct("<BBq")
+
+# Encodings of fields
+ENCODING_DELTA = 1
+ENCODING_XOR = 2
+
+# Ranges of the integer types used for delta-encoded values, indexed by width in bytes
+integer_ranges = {width: np.iinfo("<i{:d}".format(width)) for width in [1, 2, 4, 8]}
+
+
+def encode_block(arrays):
+    """
+    Encode a block of orbital elements.
+
+    :param arrays:
+        Dictionary of NumPy float64 arrays, indexed by field name, all of the same length
+    :return:
+        Bytes object containing the encoded block, including its header
+    """
+    epochs = arrays['epoch']
+    count = len(epochs)
+    payload = []
+
+    for [name, decimals] in store_fields:
+        values = np.asarray(arrays[name], dtype=np.float64)
+
+        # Quantize and delta-encode fields with a fixed number of decimal places, unless they contain NULLs
+        if decimals is not None and not np.isnan(values).any():
+            quantized = np.rint(values * 10 ** decimals).astype(np.int64)
+            deltas = np.diff(quantized)
+            width = 8
+            for candidate in [1, 2, 4]:
+                limits = integer_ranges[candidate]
+                if len(deltas) == 0 or (deltas.min() >= limits.min and deltas.max() <= limits.max):
+                    width = candidate
+                    break
+            payload.append(field_header.pack(ENCODING_DELTA, width, int(quantized[0])))
+            payload.append(deltas.astype("<i{:d}".format(width)).tobytes())
+
+        # Otherwise XOR the bit pattern of each value with the previous one, which leaves the high bits zero
+        else:
+            bits = values.astype("<f8").view("<u8")
+            xored = bits ^ np.concatenate([np.zeros(1, dtype="<u8"), bits[:-1]])
+            payload.append(field_header.pack(ENCODING_XOR, 8, 0))
+            payload.append(xored.tobytes())
+
+    compressed = zlib.compress(b"".join(payload), 6)
+    return block_header.pack(count, float(epochs[0]), float(epochs[-1]), len(compressed)) + compressed
+
+
+def decode_block(count, compressed):
+    """
+    Decode a block of orbital elements.
+
+    :param count:
+        The number of sets of elements in the block
+    :param compressed:
+        The compressed payload of the block
+    :return:
+        Dictionary of NumPy float64 arrays, indexed by field name
+    """
+    payload = zlib.decompress(compressed)
+    position = 0
+    output = {}
+
+    for [name, decimals] in store_fields:
+        [encoding, width, first] = field_header.unpack_from(payload, position)
+        position += field_header.size
+
+        if encoding == ENCODING_DELTA:
+            deltas = np.frombuffer(payload, dtype="<i{:d}".format(width), count=count - 1, offset=position)
+            position += width * (count - 1)
+            quantized = np.empty(count, dtype=np.int64)
+            quantized[0] = first
+            np.cumsum(deltas, dtype=np.int64, out=quantized[1:])
+            quantized[1:] += first
+            output[name] = quantized / float(10 ** decimals)
+        else:
+            xored = np.frombuffer(payload, dtype="<u8", count=count, offset=position)
+            position += 8 * count
+            output[name] = np.bitwise_xor.accumulate(xored).view("<f8").astype(np.float64)
+
+    return output
+
+
+def empty_arrays():
+    """
+    Return a dictionary of empty arrays, one for each stored field.
+
+    :return:
+        Dictionary of NumPy float64 arrays, indexed by field name
+    """
+    return {name: np.zeros(0, dtype=np.float64) for name in field_names}
+
+
+def concatenate_arrays(array_list):
+    """
+    Concatenate a list of dictionaries of arrays.
+
+    :param array_list:
+        List of dictionaries of NumPy arrays, indexed by field name
+    :return:
+        Dictionary of NumPy float64 arrays, indexed by field name
+    """
+    if not array_list:
+        return empty_arrays()
+    return {name: np.concatenate([arrays[name] for arrays in array_list]) for name in field_names}
+
+
+class ElementStore:
+    """
+    A directory containing one file of orbital elements for each spacecraft.
+    """
+
+    def __init__(self, path="../auto/element_store"):
+        """
+        :param path:
+            The directory in which the store is kept
+        """
+        self.path = path
+
+    def spacecraft_path(self, norad_id):
+        """
+        Return the path of the file holding the elements of a spacecraft. Files are divided between subdirectories,
+        each of which holds up to 1000 spacecraft.
+
+        :param norad_id:
+            The NORAD ID of the spacecraft
+        :return:
+            Path of file
+        """
+        return os.path.join(self.path, "{:03d}".format(norad_id // 1000), "{:d}.els".format(norad_id))
+
+    def read_metadata(self):
+        """
+        Read the store's metadata, which records the uid of the last orbit it contains.
+
+        :return:
+            Dictionary of metadata
+        """
+        try:
+            return json.loads(open(os.path.join(self.path, "store.json")).read())
+        except (ValueError, IOError):
+            return {'last_uid': 0}
+
+    def write_metadata(self, metadata):
+        """
+        Atomically update the store's metadata.
+
+        :param metadata:
+            Dictionary of metadata
+        :return:
+            None
+        """
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, "store.json.tmp")
+        open(tmp_path, "w").write(json.dumps(metadata))
+        os.replace(tmp_path, os.path.join(self.path, "store.json"))
+
+    def read(self, norad_id, start=None, end=None):
+        """
+        Read the history of orbital elements of a spacecraft, or a time window of it. Blocks which lie entirely
+        outside the time window are skipped without being decompressed.
+
+        :param norad_id:
+            The NORAD ID of the spacecraft
+        :param start:
+            Optional unix time of the earliest elements to return
+        :param end:
+            Optional unix time of the latest elements to return
+        :return:
+            Dictionary of NumPy float64 arrays, indexed by field name, sorted by epoch
+        """
+        path = self.spacecraft_path(norad_id)
+        if not os.path.exists(path):
+            return empty_arrays()
+
+        blocks = []
+        with open(path, "rb") as f:
+            if f.read(len(file_magic)) != file_magic:
+                raise ValueError("File <{}> is not an element store file".format(path))
+
+            while True:
+                header = f.read(block_header.size)
+                if len(header) < block_header.size:
+                    break
+                [count, epoch_min, epoch_max, length] = block_header.unpack(header)
+
+                if (start is not None and epoch_max < start) or (end is not None and epoch_min > end):
+                    f.seek(length, os.SEEK_CUR)
+                    continue
+
+                block = decode_block(count=count, compressed=f.read(length))
+
+                # Trim blocks which straddle the ends of the time window
+                if (start is not None and epoch_min < start) or (end is not None and epoch_max > end):
+                    mask = np.ones(count, dtype=bool)
+                    if start is not None:
+                        mask &= block['epoch'] >= start
+                    if end is not None:
+                        mask &= block['epoch'] <= end
+                    block = {name: values[mask] for name, values in block.items()}
+
+                blocks.append(block)
+
+        return concatenate_arrays(blocks)
+
+    def write(self, norad_id, arrays):
+        """
+        Replace the history of orbital elements of a spacecraft. The file is written atomically.
+
+        :param norad_id:
+            The NORAD ID of the spacecraft
+        :param arrays:
+            Dictionary of NumPy arrays, indexed by field name, sorted by epoch
+        :return:
+            The number of sets of elements written
+        """
+        path = self.spacecraft_path(norad_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        count = len(arrays['epoch'])
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as f:
+            f.write(file_magic)
+            for i in range(0, count, block_length):
+                f.write(encode_block({name: arrays[name][i:i + block_length] for name in field_names}))
+        os.replace(tmp_path, path)
+        return count
+
+    def block_index(self, norad_id):
+        """
+        Read the headers of the blocks in the file holding the elements of a spacecraft, without decompressing them.
+
+        :param norad_id:
+            The NORAD ID of the spacecraft
+        :return:
+            List of [file offset, number of records, earliest epoch, latest epoch, length of compressed payload]
+        """
+        path = self.spacecraft_path(norad_id)
+        blocks = []
+        with open(path, "rb") as f:
+            if f.read(len(file_magic)) != file_magic:
+                raise ValueError("File <{}> is not an element store file".format(path))
+
+            while True:
+                offset = f.tell()
+                header = f.read(block_header.size)
+                if len(header) < block_header.size:
+                    break
+                [count, epoch_min, epoch_max, length] = block_header.unpack(header)
+                blocks.append([offset, count, epoch_min, epoch_max, length])
+                f.seek(length, os.SEEK_CUR)
+        return blocks
+
+    def append(self, norad_id, arrays):
+        """
+        Add new sets of orbital elements to the history of a spacecraft. Only the end of the file is re-encoded: new
+        elements are merged into the last block, if it is not full. Elements imported by a backfill may be older than
+        those already stored, in which case every block from the first one they overlap onwards is merged and
+        re-encoded. Earlier blocks are copied into the new file without being decompressed, and the file is replaced
+        atomically. New elements within <duplicate_tolerance> seconds of an epoch already stored are ignored.
+
+        :param norad_id:
+            The NORAD ID of the spacecraft
+        :param arrays:
+            Dictionary of NumPy arrays, indexed by field name, sorted by epoch
+        :return:
+            The number of new sets of elements stored
+        """
+        if len(arrays['epoch']) == 0:
+            return 0
+
+        path = self.spacecraft_path(norad_id)
+        if not os.path.exists(path):
+            return self.write(norad_id, arrays)
+
+        # Find the first block which needs to be re-encoded
+        blocks = self.block_index(norad_id)
+        earliest_new = float(arrays['epoch'].min()) - duplicate_tolerance
+        rewrite_from = len(blocks)
+        for index, [offset, count, epoch_min, epoch_max, length] in enumerate(blocks):
+            if epoch_max >= earliest_new:
+                rewrite_from = index
+                break
+        if blocks and blocks[-1][1] < block_length:
+            rewrite_from = min(rewrite_from, len(blocks) - 1)
+
+        # The part of the file before the first block we re-encode is copied unchanged
+        if rewrite_from < len(blocks):
+            prefix_length = blocks[rewrite_from][0]
+        elif blocks:
+            prefix_length = blocks[-1][0] + block_header.size + blocks[-1][4]
+        else:
+            prefix_length = len(file_magic)
+
+        with open(path, "rb") as f:
+            # Decode the blocks we are going to re-encode
+            stored_blocks = []
+            for [offset, count, epoch_min, epoch_max, length] in blocks[rewrite_from:]:
+                f.seek(offset + block_header.size)
+                stored_blocks.append(decode_block(count=count, compressed=f.read(length)))
+            stored = concatenate_arrays(stored_blocks)
+
+            # Discard new elements which are already stored. Earlier blocks all end before the first new epoch.
+            stored_epochs = stored['epoch']
+            keep = np.ones(len(arrays['epoch']), dtype=bool)
+            if len(stored_epochs):
+                position = np.searchsorted(stored_epochs, arrays['epoch'])
+                before = stored_epochs[np.clip(position - 1, 0, len(stored_epochs) - 1)]
+                after = stored_epochs[np.clip(position, 0, len(stored_epochs) - 1)]
+                distance = np.minimum(np.abs(arrays['epoch'] - before), np.abs(arrays['epoch'] - after))
+                keep = distance > duplicate_tolerance
+            if not keep.any():
+                return 0
+
+            merged = concatenate_arrays([stored, {name: values[keep] for name, values in arrays.items()}])
+            order = np.argsort(merged['epoch'], kind='stable')
+            merged = {name: values[order] for name, values in merged.items()}
+
+            # Write a new file containing the unchanged blocks followed by the merged ones, and then rename it over
+            # the old one, so that readers never see a partially-written file
+            tmp_path = "{}.tmp".format(path)
+            with open(tmp_path, "wb") as output:
+                f.seek(0)
+                remaining = prefix_length
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        raise ValueError("File <{}> is truncated".format(path))
+                    output.write(chunk)
+                    remaining -= len(chunk)
+                for i in range(0, len(merged['epoch']), block_length):
+                    output.write(encode_block({name: merged[name][i:i + block_length] for name in field_names}))
+        os.replace(tmp_path, path)
+        return int(keep.sum())
+
+    def size(self, norad_id):
+        """
+        Return the size of the file holding the elements of a spacecraft.
+
+        :param norad_id:
+            The NORAD ID of the spacecraft
+        :return:
+            Size in bytes
+        """
+        path = self.spacecraft_path(norad_id)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def rows_to_arrays(rows):
+    """
+    Convert a list of rows from the spacecraft_orbits table into arrays.
+
+    :param rows:
+        List of dictionaries, each with an entry for every stored field
+    :return:
+        Dictionary of NumPy float64 arrays, indexed by field name
+    """
+    return {name: np.array([row[name] if row[name] is not None else np.nan for row in rows], dtype=np.float64)
+            for name in field_names}
+
+
+def import_orbits(logger, store, minimum_uid, action):
+    """
+    Stream orbits from the spacecraft_orbits table into the store, grouped by spacecraft.
+
+    :param logger:
+        A logging object
+    :param store:
+        ElementStore object
+    :param minimum_uid:
+        Only import orbits with uids greater than this
+    :param action:
+        Either "write" to replace each spacecraft's history, or "append" to add to it
+    :return:
+        None
+    """
+    [db, c] = shared_connection()
+    c.execute("SELECT COALESCE(MAX(uid), 0) AS last_uid FROM spacecraft_orbits;")
+    last_uid = c.fetchone()['last_uid']
+
+    cursor = server_side_cursor(db)
+    cursor.execute("SELECT noradId, " + ",".join(field_names) + " FROM spacecraft_orbits "
+                   "WHERE uid>%s AND uid<=%s ORDER BY noradId, epoch;", (minimum_uid, last_uid))
+
+    spacecraft_count = 0
+    orbit_count = 0
+    current_id = None
+    rows = []
+    for row in cursor:
+        if row['noradId'] != current_id:
+            if rows:
+                stored_count = getattr(store, action)(current_id, rows_to_arrays(rows))
+                spacecraft_count += int(stored_count > 0)
+                orbit_count += stored_count
+            current_id = row['noradId']
+            rows = []
+        rows.append(row)
+    if rows:
+        stored_count = getattr(store, action)(current_id, rows_to_arrays(rows))
+        spacecraft_count += int(stored_count > 0)
+        orbit_count += stored_count
+    cursor.close()
+
+    store.write_metadata({'last_uid': last_uid})
+    logger.info("Stored {:d} orbits for {:d} spacecraft".format(orbit_count, spacecraft_count))
+
+
+def report(logger, store, norad_id, repeats=5):
+    """
+    Compare the size and read speed of the store against the spacecraft_orbits table, for the full history of a
+    single spacecraft.
+
+    :param logger:
+        A logging object
+    :param store:
+        ElementStore object
+    :param norad_id:
+        The NORAD ID of the spacecraft
+    :param repeats:
+        The number of times to repeat each timing measurement
+    :return:
+        None
+    """
+    [db, c] = shared_connection()
+
+    # Time reading the full history from SQL into NumPy arrays
+    sql_time = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        c.execute("SELECT " + ",".join(field_names) + " FROM spacecraft_orbits WHERE noradId=%s ORDER BY epoch;",
+                  (norad_id,))
+        sql_arrays = rows_to_arrays(c.fetchall())
+        duration = time.perf_counter() - start
+        sql_time = duration if sql_time is None else min(sql_time, duration)
+
+    # Time reading the full history from the store
+    store_time = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        store_arrays = store.read(norad_id)
+        duration = time.perf_counter() - start
+        store_time = duration if store_time is None else min(store_time, duration)
+
+    # Estimate the space used by these rows in SQL, pro rata from the table's data and index sizes
+    count = len(sql_arrays['epoch'])
+    c.execute("SELECT DATA_LENGTH, INDEX_LENGTH, TABLE_ROWS FROM information_schema.TABLES "
+              "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='spacecraft_orbits';")
+    table_info = c.fetchone()
+    sql_size = 0
+    if table_info and table_info['TABLE_ROWS']:
+        sql_size = count * (table_info['DATA_LENGTH'] + table_info['INDEX_LENGTH']) / table_info['TABLE_ROWS']
+    store_size = store.size(norad_id)
+
+    # Check the store matches SQL, to within the quantization of each field
+    max_errors = {}
+    if len(store_arrays['epoch']) == count:
+        for name in field_names:
+            differences = np.abs(np.nan_to_num(store_arrays[name]) - np.nan_to_num(sql_arrays[name]))
+            max_errors[name] = float(differences.max()) if count else 0
+
+    logger.info("Element history of NORAD ID {:d}: {:d} sets of elements in SQL; {:d} in store".
+                format(norad_id, count, len(store_arrays['epoch'])))
+    logger.info("  {:32s} {:12.0f} bytes ({:.1f} bytes per set)".
+                format("SQL (data + indexes, estimated)", sql_size, sql_size / max(count, 1)))
+    logger.info("  {:32s} {:12.0f} bytes ({:.1f} bytes per set)".
+                format("Element store", store_size, store_size / max(count, 1)))
+    logger.info("  {:32s} {:12.3f} ms".format("SQL read time", sql_time * 1e3))
+    logger.info("  {:32s} {:12.3f} ms".format("Element store read time", store_time * 1e3))
+    for name in field_names:
+        if name in max_errors:
+            logger.info("  Maximum difference in {:18s} {:.3g}".format(name, max_errors[name]))
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        stream=sys.stdout,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=["build", "update", "report"],
+                        help="Action to perform")
+    parser.add_argument('--store', dest='store', default="../auto/element_store",
+                        help="Directory in which the element store is kept")
+    parser.add_argument('--norad', dest='norad_id', type=int, default=25544,
+                        help="NORAD ID of the spacecraft to use in the report")
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+    store = ElementStore(path=args.store)
+
+    if args.action == "build":
+        import_orbits(logger=logger, store=store, minimum_uid=0, action="write")
+    elif args.action == "update":
+        import_orbits(logger=logger, store=store,
+                      minimum_uid=max(0, store.read_metadata()['last_uid'] - update_uid_margin), action="append")
+    else:
+        report(logger=logger, store=store, norad_id=args.norad_id)
+
+    close_shared_connection()
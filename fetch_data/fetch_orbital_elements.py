@@ -6,7 +6,7 @@
 Query the Celestrak and space-track websites for up-to-date orbital elements for spacecraft.
 """
 
-import calendar
+import argparse
 import json
 import logging
 import os
@@ -14,99 +14,70 @@ import sys
 import time
 
 import satcat_fetch
-from connect_db import connect_db
+import sqlite_snapshot
+import tle_export
+from connect_db import shared_connection, close_shared_connection, execute_statement
+from profiling import profile_run
+from tle_parser import read_tle_file, ParallelTleReader
 
 
-def read_tle_file(path, c, sat_mags, group, source):
+def read_mcnames(path, sat_mags):
     """
-    Parse a two-line element (TLE) file and extract the list of orbital elements from it.
+    Extract the magnitudes of spacecraft from Mike McCants's <mcnames> file.
 
     :param path:
-        The path of the TLE file we should parse
-    :param c:
-        A MySQLdb database connection handle
+        The path of the mcnames file
     :param sat_mags:
-        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID
-    :param group:
-        The name of the (sub)group of satellites contained within this TLE file
-    :param source:
-        The source ID number for these orbital elements
+        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID, which we update
     :return:
-        A list of lists containing the orbital elements we extracted from the file
+        None
     """
+    for line in open(path):
+        try:
+            sat_mags[int(line[0:5])] = float(line[37:42])
+        except ValueError:
+            pass
 
-    items = []
-    lines = open(path).readlines()
-    line_count = 0
-
-    while line_count < len(lines):
-        # First line of a set of TLEs must start with "1 ". Celestrak intersperse TLEs with names
-        if not lines[line_count].startswith("1 "):
-            line_count += 1
-            continue
-
-        i = line_count - 1
-        norad_id = int(lines[i + 1][2: 7])
-        incl = float(lines[i + 2][8:16])
-        ecc = float("0." + lines[i + 2][26:33])
-        ra_asc = float(lines[i + 2][17:25])
-        arg_peri = float(lines[i + 2][34:42])
-        mean_anom = float(lines[i + 2][43:51])
-        mean_motion = float(lines[i + 2][52:63])
-        year = int("20" + lines[i + 1][18:20])
-        day = float(lines[i + 1][20:32])
-
-        mean_motion_dot = ((-1 if lines[i + 1][33] == "-" else 1) *
-                           float(lines[i + 1][34:43]) * 2)
-
-        mean_motion_dot_dot = ((-1 if lines[i + 1][44] == "-" else 1) *
-                               float("0." + lines[i + 1][45:50] + "E" + lines[i + 1][50:52]) * 6)
-
-        b_star = ((-1 if lines[i + 1][53] == "-" else 1) *
-                  float("0." + lines[i + 1][54:59] + "E" + lines[i + 1][59:61]))
-
-        rev_count = float(lines[i + 2][63:68])
-
-        epoch = calendar.timegm((year, 1, 1, 0, 0, 0, 0, 0, 0))
-        epoch += (day - 1) * 3600 * 24  # January 1st is day 1
-        if norad_id in sat_mags:
-            mag = sat_mags[norad_id]
-        else:
-            if group and group['subgroupname'] == 'Starlink':
-                # Hard code a standard magnitude for all Starlink satellites!
-                mag = 5.5
-            else:
-                mag = None
-
-        items.append([
-            group,
-            norad_id,
-            (norad_id, epoch, incl, ecc, ra_asc, arg_peri, mean_anom, mean_motion, mag,
-             mean_motion_dot, mean_motion_dot_dot, b_star, source, rev_count),
-        ])
 
-        line_count += 2
+def read_quicksat(path, sat_mags):
+    """
+    Extract the magnitudes of spacecraft from Mike McCants's <qs.mag> file. These values are used in preference to
+    those in <mcnames>, so this should be read second.
 
-    return items
+    :param path:
+        The path of the qs.mag file
+    :param sat_mags:
+        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID, which we update
+    :return:
+        None
+    """
+    for line in open(path):
+        try:
+            # Quicksat figures for full phase; formula in satcalc.js assumes reference mag at 90 deg phase
+            sat_mags[int(line[0:5])] = float(line[33:37]) + 1.2428746817353344
+        except ValueError:
+            pass
 
 
-def main_spacecraft(logger):
+def main_spacecraft(logger, parse_processes=0):
     """
     Main entry point to query the Celestrak and space-track websites for up-to-date orbital elements for spacecraft.
 
     :param logger:
         A logging object
+    :param parse_processes:
+        The number of worker processes to use to parse TLE files. If zero, files are parsed serially.
     :return:
         None
     """
 
+    # Connect to database. SATCAT and the orbital elements are imported within a single transaction
+    [db, c] = shared_connection()
+    c.execute("BEGIN;")
+
     # Read SATCAT from the Celestrak website. Build catalogue of all spacecraft
     logger.info("Fetching SATCAT")
-    satcat_fetch.satcat_fetch()
-
-    # Connect to database
-    [db, c] = connect_db()
-    c.execute("BEGIN;")
+    satcat_fetch.satcat_fetch(db=db, c=c)
 
     # Make a persistent working directory
     tmpdir = "../auto/tmp/spacecraft"
@@ -148,11 +119,7 @@ def main_spacecraft(logger):
 
     # Extract magnitudes of spacecraft from the mcnames file
     logger.info("Extracting magnitudes from mcnames")
-    for line in open("../auto/tmp/spacecraft/mcnames"):
-        try:
-            sat_mags[int(line[0:5])] = float(line[37:42])
-        except ValueError:
-            pass
+    read_mcnames(path="../auto/tmp/spacecraft/mcnames", sat_mags=sat_mags)
 
     # Continue fetching spacecraft magnitude data from Mike McCants's website
     # Secondly, download quicksat file which is more widely used and about 1.4 mag brighter
@@ -188,12 +155,7 @@ def main_spacecraft(logger):
 
     # Extract magnitudes of spacecraft from the qs.mag file
     logger.info("Extracting magnitudes from qs.mag")
-    for line in open("../auto/tmp/spacecraft/qs.mag"):
-        try:
-            # Quicksat figures for full phase; formula in satcalc.js assumes reference mag at 90 deg phase
-            sat_mags[int(line[0:5])] = float(line[33:37]) + 1.2428746817353344
-        except ValueError:
-            pass
+    read_quicksat(path="../auto/tmp/spacecraft/qs.mag", sat_mags=sat_mags)
 
     # Register epoch at which we fetched data
     epoch = time.time()
@@ -210,6 +172,13 @@ def main_spacecraft(logger):
               "INNER JOIN spacecraft_leo_groups g ON s.parent=g.uid;")
     groups = c.fetchall()
 
+    # If requested, start a pool of processes to parse TLE files while we continue downloading others
+    parser_pool = None
+    pending_files = []  # List of [position in <items>, PendingTleFile]
+    if parse_processes:
+        logger.info("Parsing TLE files with {:d} worker processes".format(parse_processes))
+        parser_pool = ParallelTleReader(sat_mags=sat_mags, processes=parse_processes)
+
     # Download TLEs for all spacecraft (sub)groups from the Celestrak website
     items = []
     for group in groups:
@@ -241,8 +210,11 @@ def main_spacecraft(logger):
                 os.system("cd {} ; mv {}_old {}".format(tmpdir, filename, filename))
 
             # Read TLE file
-            new_items = read_tle_file(path, c, sat_mags, group, 0)
-            items.extend(new_items)
+            if parser_pool:
+                pending_files.append([len(items), parser_pool.submit(path, group, 0)])
+            else:
+                new_items = read_tle_file(path, c, sat_mags, group, 0)
+                items.extend(new_items)
 
     # Download TLEs for all spacecraft from the space-track website
     last_downloaded = 0
@@ -272,8 +244,18 @@ def main_spacecraft(logger):
 
             # Read TLE file
             logger.info("Adding TLEs from spacetrack")
-            new_items = read_tle_file("../auto/tmp/spacecraft/spacetrack.tle", c, sat_mags, None, 1)
-            items.extend(new_items)
+            if parser_pool:
+                pending_files.append([len(items),
+                                      parser_pool.submit("../auto/tmp/spacecraft/spacetrack.tle", None, 1)])
+            else:
+                new_items = read_tle_file("../auto/tmp/spacecraft/spacetrack.tle", c, sat_mags, None, 1)
+                items.extend(new_items)
+
+    # Collect the output of the parser processes, inserting it into <items> in the same order as a serial parse
+    if parser_pool:
+        for position, pending_file in reversed(pending_files):
+            items[position:position] = pending_file.get()
+        parser_pool.close()
 
     # Now add each set of TLEs to the database
     logger.info("Importing TLEs into database")
@@ -282,7 +264,7 @@ def main_spacecraft(logger):
     unchanged_elements = 0
     for (group, norad_id, elements) in items:
         # Check that spacecraft is in table
-        c.execute("SELECT 1 FROM spacecraft WHERE noradId=%s;", (norad_id,))
+        execute_statement(c, 'spacecraft_exists', (norad_id,))
         result = c.fetchall()
         if len(result) < 1:
             continue
@@ -291,22 +273,15 @@ def main_spacecraft(logger):
         if elements:
             downloaded_elements += 1
             # If we already have an orbit for this spacecraft at this epoch, we don't need another
-            c.execute("SELECT orbitId FROM spacecraft_orbit_epochs WHERE noradId=%s AND epochId=%s;",
-                      (norad_id, epoch_id))
+            execute_statement(c, 'orbit_epoch_exists', (norad_id, epoch_id))
             result = c.fetchall()
             if len(result) < 1:
                 # If we already have a copy of this spacecraft orbit, count it as a duplicate
-                c.execute("""
-SELECT uid FROM spacecraft_orbits WHERE noradId=%s AND epoch BETWEEN (%s-1) AND (%s+1);
-""", (norad_id, elements[1], elements[1]))
+                execute_statement(c, 'orbit_near_epoch', (norad_id, elements[1], elements[1]))
                 result = c.fetchall()
                 if len(result) < 1:
                     # New orbit, so create new record for it
-                    c.execute("""
-INSERT INTO spacecraft_orbits (noradId,epoch,incl,ecc,RAasc,argPeri,meanAnom,meanMotion,mag,
-                                        meanMotionDot,meanMotionDotDot,bStar,source,revCount)
-VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);
-""", elements)
+                    execute_statement(c, 'insert_orbit', elements)
                     orbit_id = db.insert_id()
                     is_duplicate = False
                     inserted_elements += 1
@@ -317,15 +292,11 @@ VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);
                     unchanged_elements += 1
 
                 # Register orbit for this spacecraft, epoch combination
-                c.execute("INSERT INTO spacecraft_orbit_epochs (noradId, epochId, orbitId, duplicate)"
-                          "VALUES (%s,%s,%s,%s);",
-                          (norad_id, epoch_id, orbit_id, is_duplicate))
+                execute_statement(c, 'insert_orbit_epoch', (norad_id, epoch_id, orbit_id, is_duplicate))
 
         # Populate one-to-many table with group that this spacecraft is in
         if group:
-            c.execute("INSERT INTO spacecraft_leo_groupmembers (noradId, groupId) "
-                      "VALUES (%s,(SELECT uid FROM spacecraft_leo_subgroups WHERE name=%s));",
-                      (norad_id, group["subgroupname"]))
+            execute_statement(c, 'insert_group_member', (norad_id, group["subgroupname"]))
 
     # Check for spacecraft which had orbits in previous epochId, but not this one
     duplicated_elements = satcat_fetch.duplicate_elements(logger=logger, c=c,
@@ -347,7 +318,15 @@ VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);
     logger.info("Cleaning up")
     c.execute("COMMIT;")
     db.commit()
-    db.close()
+
+    # Render TLE files for each group of spacecraft at this new epoch
+    logger.info("Exporting TLE files")
+    tle_export.export_latest(logger=logger, epoch_id=epoch_id)
+
+    # Publish a read-only snapshot of the catalogue and these elements for the web workers
+    logger.info("Publishing SQLite snapshot")
+    sqlite_snapshot.build_snapshot(logger=logger, epoch_id=epoch_id)
+    close_shared_connection()
 
 
 # Do it right away if we're run as a script
@@ -356,7 +335,16 @@ if __name__ == "__main__":
                         stream=sys.stdout,
                         format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
                         datefmt='%d/%m/%Y %H:%M:%S')
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--parse-processes', dest='parse_processes', type=int, default=0,
+                        help="Number of worker processes to use to parse TLE files (default: parse serially)")
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help="Write a profile of this run into ../auto/tmp/profile")
+    args = parser.parse_args()
+
     logger = logging.getLogger(__name__)
     logger.info(__doc__.strip())
 
-    main_spacecraft(logger=logger)
+    with profile_run(name="fetch_orbital_elements", enabled=args.profile, logger=logger):
+        main_spacecraft(logger=logger, parse_processes=args.parse_processes)
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# profiling.py
+
+"""
+Profile a complete run of one of our scripts. This records:
+
+* a cProfile trace of the main thread;
+* a wall-clock profile, made by sampling the stack of every thread at regular intervals, written in the folded-stack
+  format read by flamegraph.pl and speedscope;
+* the SQL statements which took the most time, measured by the database cursors.
+
+These are written into <../auto/tmp/profile>, along with a text summary and a JSON summary. The JSON summaries of two
+runs can be compared to spot regressions, using:
+
+    ./profiling.py diff <old summary.json> <new summary.json>
+"""
+
+import argparse
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+import connect_db
+
+# Default directory into which profiles are written
+profile_path = "../auto/tmp/profile"
+
+
+def normalise_statement(query):
+    """
+    Normalise the text of an SQL statement, so that executions of the same statement are grouped together.
+
+    :param query:
+        The SQL statement, as a string or bytes
+    :return:
+        String
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', errors='replace')
+    query = re.sub(r"\s+", " ", query).strip()
+
+    # Lists of placeholders of varying length, e.g. IN (%s,%s,%s), are collapsed to a single entry
+    query = re.sub(r"%s(\s*,\s*%s)+", "%s,...", query)
+    return query
+
+
+def frame_name(frame):
+    """
+    Describe a stack frame, in the form used in folded stack profiles.
+
+    :param frame:
+        A Python frame object
+    :return:
+        String
+    """
+    code = frame.f_code
+    return "{} ({}:{:d})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class RunProfiler:
+    """
+    Context manager which profiles the code that runs within it.
+    """
+
+    def __init__(self, name, logger=None, output_dir=profile_path, interval=0.005, top_count=40):
+        """
+        :param name:
+            The name of the script being profiled, used in the output filenames
+        :param logger:
+            A logging object
+        :param output_dir:
+            The directory into which profiles are written
+        :param interval:
+            The interval between samples of the stack, seconds
+        :param top_count:
+            The number of functions and SQL statements to list in the summaries
+        """
+        self.name = name
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.output_dir = output_dir
+        self.interval = interval
+        self.top_count = top_count
+
+        self.profile = cProfile.Profile()
+        self.stack_counts = {}
+        self.sample_count = 0
+        self.sql = {}
+        self.sql_lock = threading.Lock()
+        self.stop_sampling = threading.Event()
+        self.sampler = None
+        self.start_time = None
+        self.wall_time = None
+        self.active = False
+
+        # Child processes forked while profiling, such as the TLE parser pool, inherit the profiler hook, which slows
+        # them down. Their profile data would be discarded in any case, so turn it off in the child.
+        os.register_at_fork(after_in_child=self.after_fork_in_child)
+
+    def after_fork_in_child(self):
+        """
+        Stop profiling in a child process forked while the profiler was active.
+
+        :return:
+            None
+        """
+        if self.active:
+            self.active = False
+            self.profile.disable()
+            connect_db.statement_timer = None
+
+    def record_statement(self, query, duration, executions):
+        """
+        Record the time taken to execute an SQL statement, or to fetch its results. This is called by the database
+        cursors.
+
+        :param query:
+            The SQL statement
+        :param duration:
+            The time taken, seconds
+        :param executions:
+            The number of times the statement was executed, or zero if this is the time taken to fetch its results
+        :return:
+            None
+        """
+        key = normalise_statement(query)
+        with self.sql_lock:
+            if key not in self.sql:
+                self.sql[key] = [0, 0.]
+            self.sql[key][0] += executions
+            self.sql[key][1] += duration
+
+    def sample_stacks(self):
+        """
+        Sample the stacks of all threads at regular intervals, until told to stop.
+
+        :return:
+            None
+        """
+        sampler_id = threading.get_ident()
+        thread_names = {}
+        while not self.stop_sampling.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, frame in frames.items():
+                if thread_id == sampler_id:
+                    continue
+                if thread_id not in thread_names:
+                    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, "thread"))
+                key = ";".join(reversed(stack))
+                self.stack_counts[key] = self.stack_counts.get(key, 0) + 1
+            self.sample_count += 1
+
+    def __enter__(self):
+        self.start_time = time.time()
+        connect_db.statement_timer = self.record_statement
+        self.sampler = threading.Thread(target=self.sample_stacks, name="profile-sampler", daemon=True)
+        self.sampler.start()
+        self.active = True
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.disable()
+        self.active = False
+        self.stop_sampling.set()
+        self.sampler.join()
+        connect_db.statement_timer = None
+        self.wall_time = time.time() - self.start_time
+        self.write_outputs()
+        return False
+
+    def summary(self):
+        """
+        Build a summary of the profile, which can be compared against other runs.
+
+        :return:
+            Dictionary
+        """
+        stats = pstats.Stats(self.profile)
+        functions = {}
+        for (filename, line, function), (cc, nc, tottime, cumtime, callers) in stats.stats.items():
+            key = "{} ({}:{:d})".format(function, os.path.basename(filename), line)
+            functions[key] = {'calls': nc, 'tottime': tottime, 'cumtime': cumtime}
+        top_functions = sorted(functions, key=lambda key: -functions[key]['cumtime'])[:self.top_count * 5]
+
+        return {
+            'name': self.name,
+            'start_time': self.start_time,
+            'wall_time': self.wall_time,
+            'samples': self.sample_count,
+            'functions': {key: functions[key] for key in top_functions},
+            'sql': {key: {'count': count, 'time': duration} for key, (count, duration) in self.sql.items()}
+        }
+
+    def write_outputs(self):
+        """
+        Write the profile, folded stacks and summaries to disk.
+
+        :return:
+            None
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        stem = os.path.join(self.output_dir, "{}_{}".format(self.name, time.strftime("%Y%m%d_%H%M%S",
+                                                                                   time.gmtime(self.start_time))))
+
+        # cProfile trace, which can be loaded with pstats or snakeviz
+        self.profile.dump_stats("{}.prof".format(stem))
+
+        # Folded stacks, which can be passed to flamegraph.pl
+        with open("{}.folded".format(stem), "w") as f:
+            for stack, count in sorted(self.stack_counts.items()):
+                f.write("{} {:d}\n".format(stack, count))
+
+        # JSON summary, for comparison between runs
+        summary = self.summary()
+        with open("{}.json".format(stem), "w") as f:
+            f.write(json.dumps(summary, indent=1, sort_keys=True))
+
+        # Text summary
+        with open("{}.txt".format(stem), "w") as f:
+            f.write("Profile of <{}>, started {}\n".format(self.name, time.strftime("%Y-%m-%d %H:%M:%S UTC",
+                                                                                     time.gmtime(self.start_time))))
+            f.write("Wall-clock time: {:.2f} sec ({:d} stack samples)\n\n".format(self.wall_time, self.sample_count))
+
+            f.write("Top SQL statements by cumulative time:\n")
+            f.write("{:>10s} {:>10s} {:>10s}  {}\n".format("time/s", "count", "ms/each", "statement"))
+            for query, (count, duration) in sorted(self.sql.items(), key=lambda item: -item[1][1])[:self.top_count]:
+                f.write("{:10.3f} {:10d} {:10.3f}  {}\n".format(duration, count, duration / max(count, 1) * 1e3,
+                                                                query[:200]))
+
+            f.write("\nTop functions by wall-clock samples (including time spent in callees):\n")
+            inclusive = {}
+            for stack, count in self.stack_counts.items():
+                for frame in set(stack.split(";")[1:]):
+                    inclusive[frame] = inclusive.get(frame, 0) + count
+            for frame, count in sorted(inclusive.items(), key=lambda item: -item[1])[:self.top_count]:
+                f.write("{:10.3f} {:6.1f}%  {}\n".format(count * self.interval,
+                                                         count / max(self.sample_count, 1) * 100, frame))
+
+            f.write("\nTop functions by cumulative time (cProfile, main thread):\n")
+            stream = io.StringIO()
+            pstats.Stats(self.profile, stream=stream).sort_stats("cumulative").print_stats(self.top_count)
+            f.write(stream.getvalue())
+
+        self.logger.info("Wrote profile to <{}.*>".format(stem))
+
+
+class NullProfiler:
+    """
+    Context manager which does nothing, used when profiling is not enabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def profile_run(name, enabled, logger=None):
+    """
+    Return a context manager which profiles the code within it, if profiling is enabled.
+
+    :param name:
+        The name of the script being profiled, used in the output filenames
+    :param enabled:
+        Boolean flag indicating whether to profile
+    :param logger:
+        A logging object
+    :return:
+        Context manager
+    """
+    if enabled:
+        return RunProfiler(name=name, logger=logger)
+    return NullProfiler()
+
+
+def diff_summaries(old_path, new_path, top_count=30):
+    """
+    Compare the JSON summaries of two profiled runs, listing the functions and SQL statements whose time changed the
+    most.
+
+    :param old_path:
+        The path of the JSON summary of the earlier run
+    :param new_path:
+        The path of the JSON summary of the later run
+    :param top_count:
+        The number of functions and SQL statements to list
+    :return:
+        None
+    """
+    old = json.loads(open(old_path).read())
+    new = json.loads(open(new_path).read())
+
+    print("Wall-clock time: {:.2f} sec -> {:.2f} sec ({:+.1f}%)".
+          format(old['wall_time'], new['wall_time'], (new['wall_time'] / old['wall_time'] - 1) * 100))
+
+    for [title, section, time_key, count_key] in [["Functions (cumulative time)", "functions", "cumtime", "calls"],
+                                                  ["SQL statements (cumulative time)", "sql", "time", "count"]]:
+        print("\n{}:".format(title))
+        print("{:>10s} {:>10s} {:>10s} {:>10s} {:>10s}  {}".format("old/s", "new/s", "change/s", "old n", "new n",
+                                                                   "name"))
+        keys = set(old[section]) | set(new[section])
+        rows = []
+        for key in keys:
+            old_item = old[section].get(key, {time_key: 0, count_key: 0})
+            new_item = new[section].get(key, {time_key: 0, count_key: 0})
+            rows.append([new_item[time_key] - old_item[time_key], old_item, new_item, key])
+        rows.sort(key=lambda row: -abs(row[0]))
+        for [change, old_item, new_item, key] in rows[:top_count]:
+            print("{:10.3f} {:10.3f} {:+10.3f} {:10d} {:10d}  {}".format(old_item[time_key], new_item[time_key],
+                                                                       change, old_item[count_key],
+                                                                       new_item[count_key], key[:120]))
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    diff_parser = subparsers.add_parser('diff', help="Compare the JSON summaries of two profiled runs")
+    diff_parser.add_argument('old', help="JSON summary of the earlier run")
+    diff_parser.add_argument('new', help="JSON summary of the later run")
+    diff_parser.add_argument('--top', dest='top', type=int, default=30,
+                             help="Number of functions and statements to list")
+    args = parser.parse_args()
+
+    diff_summaries(old_path=args.old, new_path=args.new, top_count=args.top)
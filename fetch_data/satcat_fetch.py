@@ -6,12 +6,16 @@ Functions to download SATCAT -- i.e. a listing of all spacecraft with NORAD ID n
 and insert them all into the spacecraft table in the database.
 """
 
+import argparse
 import datetime
+import logging
 import os
 import re
+import sys
 import time
 
-from connect_db import connect_db
+from connect_db import shared_connection, close_shared_connection, execute_statement
+from profiling import profile_run
 from vendor import xmltodict
 
 
@@ -56,18 +60,22 @@ def insert_name(c, norad_id, name, source, primary):
         c.execute("UPDATE spacecraft_names SET primaryName=0 WHERE noradId=%s;", (norad_id,))
 
     # Insert this name
-    c.execute("INSERT INTO spacecraft_names (noradId,name,source,primaryName) VALUES (%s,%s,%s,%s);",
-              (norad_id, name.strip(), source, primary))
+    execute_statement(c, 'insert_name', (norad_id, name.strip(), source, primary))
 
     # If this name contains the string "DEB", we mark this spacecraft is being debris
     if " DEB" in name:
         c.execute("UPDATE spacecraft SET isDebris=1 WHERE noradId=%s;", (norad_id,))
 
 
-def satcat_fetch():
+def satcat_fetch(db=None, c=None):
     """
     Main entry point for downloading SATCAT and importing its contents into the database.
 
+    :param db:
+        A MySQLdb database handle. If supplied, SATCAT is imported within the caller's open transaction, which the
+        caller is responsible for committing. Otherwise we open our own connection.
+    :param c:
+        A MySQLdb database connection handle, to be used with <db>
     :return:
         None
     """
@@ -76,9 +84,11 @@ def satcat_fetch():
     tmpdir = "../auto/tmp/satellites"
     os.system("mkdir -p {}".format(tmpdir))
 
-    # Open database
-    [db, c] = connect_db()
-    c.execute("BEGIN;")
+    # Open database, unless we are sharing the caller's connection
+    own_connection = c is None
+    if own_connection:
+        [db, c] = shared_connection()
+        c.execute("BEGIN;")
 
     # Ensure all data is transferred from XML to database
     # Read source XML data
@@ -178,7 +188,7 @@ def satcat_fetch():
                 pass
 
             # See whether this satellite is already in the spacecraft table. If no, create a stub entry for it
-            c.execute("SELECT noradId FROM spacecraft WHERE noradId=%s;", (norad_id,))
+            execute_statement(c, 'spacecraft_exists_by_id', (norad_id,))
             result = c.fetchall()
             if len(result) < 1:
                 c.execute("INSERT INTO spacecraft (noradId) VALUES (%s);", (norad_id,))
@@ -234,7 +244,7 @@ DELETE FROM spacecraft_names WHERE source=0 AND noradId=%s;
                 bits = line.split("|")
                 norad_id = int(bits[0])
                 # Make sure that spacecraft actually exists in database
-                c.execute("SELECT noradId FROM spacecraft WHERE noradId=%s;", (norad_id,))
+                execute_statement(c, 'spacecraft_exists_by_id', (norad_id,))
                 if c.rowcount > 0:
                     for alt_name in bits[1:]:
                         alt_name = alt_name.strip()
@@ -247,9 +257,10 @@ DELETE FROM spacecraft_names WHERE source=0 AND noradId=%s;
                             insert_name(c=c, norad_id=norad_id, name=alt_name, source=1, primary=primary)
 
     # Commit databases
-    c.execute("COMMIT;")
-    db.commit()
-    db.close()
+    if own_connection:
+        c.execute("COMMIT;")
+        db.commit()
+        close_shared_connection()
 
 
 def duplicate_elements(logger, c, epoch, epoch_id, maximum_age_days=10):
@@ -324,4 +335,15 @@ INSERT INTO spacecraft_orbit_epochs (noradId, epochId, orbitId, duplicate) VALUE
 
 # Do it right away if we're run as a script
 if __name__ == "__main__":
-    satcat_fetch()
+    logging.basicConfig(level=logging.INFO,
+                        stream=sys.stdout,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help="Write a profile of this run into ../auto/tmp/profile")
+    args = parser.parse_args()
+
+    with profile_run(name="satcat_fetch", enabled=args.profile, logger=logging.getLogger(__name__)):
+        satcat_fetch()
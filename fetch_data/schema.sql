@@ -102,6 +102,23 @@ CREATE TABLE spacecraft_orbit_epochs
     FOREIGN KEY (noradId) REFERENCES spacecraft (noradId) ON DELETE CASCADE
 );
 
+/* Events found in the histories of orbital elements by <detect_events.py>. For manoeuvres, <value> is the size of
+   the jump, and <score> is its size relative to the scatter of the spacecraft's elements. For decay, <value> is the
+   latest value of the parameter, and <score> is its rate of increase per day. */
+CREATE TABLE spacecraft_events
+(
+    uid          INTEGER PRIMARY KEY AUTO_INCREMENT,
+    noradId      INTEGER     NOT NULL,
+    epoch        REAL        NOT NULL,
+    eventType    VARCHAR(16) NOT NULL,
+    parameter    VARCHAR(16) NOT NULL,
+    value        REAL,
+    score        REAL,
+    UNIQUE (noradId, epoch, eventType, parameter),
+    INDEX (epoch),
+    FOREIGN KEY (noradId) REFERENCES spacecraft (noradId) ON DELETE CASCADE
+);
+
 CREATE TABLE spacecraft_leo_groups
 (
     uid  INTEGER PRIMARY KEY AUTO_INCREMENT,
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# sqlite_snapshot.py
+
+"""
+Publish a self-contained, read-only SQLite snapshot of the spacecraft catalogue, so that web workers can look up
+spacecraft, their names, group memberships and current orbital elements without any round trips to MySQL.
+
+The snapshot is written to <../auto/snapshot/spacecraft.sqlite> after each new epoch is committed. It is built in a
+temporary file by bulk insertion, with indexes created afterwards, and then renamed over the previous snapshot. Since
+a published snapshot is never modified in place, workers may open it with <open_snapshot>, which treats the file as
+immutable and memory-maps it. A worker that holds a snapshot open keeps reading the old file until it reopens it; the
+current epoch of a snapshot is recorded in the <snapshot_info> table.
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from connect_db import shared_connection, close_shared_connection, server_side_cursor
+
+# Path of the published snapshot
+snapshot_path = "../auto/snapshot/spacecraft.sqlite"
+
+# Number of rows to fetch from MySQL and insert into SQLite at a time
+batch_size = 10000
+
+# Maximum number of bytes of the snapshot that readers memory-map
+mmap_size = 512 * 1024 * 1024
+
+# The tables in the snapshot. For each, we list its columns, and the MySQL query which returns its contents, with
+# columns named as in the snapshot. The query for <spacecraft_elements> is passed the ID of the snapshot epoch.
+snapshot_tables = [
+    {
+        'name': 'spacecraft_owners',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['abbrev', 'TEXT'], ['name', 'TEXT']],
+        'query': "SELECT uid, abbrev, name FROM spacecraft_owners;"
+    },
+    {
+        'name': 'spacecraft_launchsites',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['abbrev', 'TEXT'], ['name', 'TEXT']],
+        'query': "SELECT uid, abbrev, name FROM spacecraft_launchsites;"
+    },
+    {
+        'name': 'spacecraft_statuses',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['abbrev', 'TEXT'], ['name', 'TEXT']],
+        'query': "SELECT uid, abbrev, name FROM spacecraft_statuses;"
+    },
+    {
+        'name': 'spacecraft_orbital_parent',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['abbrev', 'TEXT'], ['name', 'TEXT'], ['adjective', 'TEXT']],
+        'query': "SELECT uid, abbrev, name, adjective FROM spacecraft_orbital_parent;"
+    },
+    {
+        'name': 'spacecraft_orbital_fate',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['abbrev', 'TEXT'], ['name', 'TEXT']],
+        'query': "SELECT uid, abbrev, name FROM spacecraft_orbital_fate;"
+    },
+    {
+        'name': 'spacecraft',
+        'columns': [['noradId', 'INTEGER PRIMARY KEY'], ['cosparId', 'TEXT'], ['launchDate', 'REAL'],
+                    ['decayDate', 'REAL'], ['owner', 'INTEGER'], ['launchSite', 'INTEGER'],
+                    ['operationalStatus', 'INTEGER'], ['orbitalParent', 'INTEGER'], ['orbitalFate', 'INTEGER'],
+                    ['orbitalPeriod', 'REAL'], ['isDebris', 'INTEGER']],
+        'query': "SELECT noradId, cosparId, launchDate, decayDate, owner, launchSite, operationalStatus, "
+                 "orbitalParent, orbitalFate, orbitalPeriod, isDebris FROM spacecraft ORDER BY noradId;"
+    },
+    {
+        'name': 'spacecraft_names',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['noradId', 'INTEGER'], ['name', 'TEXT'],
+                    ['primaryName', 'INTEGER'], ['source', 'INTEGER']],
+        'query': "SELECT uid, noradId, name, primaryName, source FROM spacecraft_names ORDER BY uid;"
+    },
+    {
+        'name': 'spacecraft_leo_groups',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['name', 'TEXT']],
+        'query': "SELECT uid, name FROM spacecraft_leo_groups;"
+    },
+    {
+        'name': 'spacecraft_leo_subgroups',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['name', 'TEXT'], ['parent', 'INTEGER'], ['url', 'TEXT']],
+        'query': "SELECT uid, name, parent, url FROM spacecraft_leo_subgroups;"
+    },
+    {
+        'name': 'spacecraft_leo_groupmembers',
+        'columns': [['uid', 'INTEGER PRIMARY KEY'], ['noradId', 'INTEGER'], ['groupId', 'INTEGER']],
+        'query': "SELECT uid, noradId, groupId FROM spacecraft_leo_groupmembers;"
+    },
+    {
+        'name': 'spacecraft_elements',
+        'columns': [['noradId', 'INTEGER PRIMARY KEY'], ['orbitId', 'INTEGER'], ['epoch', 'REAL'], ['incl', 'REAL'],
+                    ['ecc', 'REAL'], ['RAasc', 'REAL'], ['argPeri', 'REAL'], ['meanAnom', 'REAL'],
+                    ['meanMotion', 'REAL'], ['meanMotionDot', 'REAL'], ['meanMotionDotDot', 'REAL'],
+                    ['bStar', 'REAL'], ['mag', 'REAL'], ['revCount', 'INTEGER'], ['source', 'INTEGER'],
+                    ['duplicate', 'INTEGER']],
+        'query': """
+SELECT oe.noradId, o.uid AS orbitId, o.epoch, o.incl, o.ecc, o.RAasc, o.argPeri, o.meanAnom, o.meanMotion,
+       o.meanMotionDot, o.meanMotionDotDot, o.bStar, o.mag, o.revCount, o.source, oe.duplicate
+FROM spacecraft_orbit_epochs oe
+INNER JOIN spacecraft_orbits o ON o.uid=oe.orbitId
+WHERE oe.epochId=%s
+ORDER BY oe.noradId;
+"""
+    },
+    {
+        'name': 'snapshot_info',
+        'columns': [['epochId', 'INTEGER'], ['epoch', 'REAL'], ['created', 'REAL']],
+        'query': None
+    }
+]
+
+# Indexes needed by the read paths, which are created after the tables have been filled
+snapshot_indexes = [
+    "CREATE INDEX spacecraft_cosparId ON spacecraft (cosparId);",
+    "CREATE INDEX spacecraft_names_noradId ON spacecraft_names (noradId, primaryName);",
+    "CREATE INDEX spacecraft_names_name ON spacecraft_names (name COLLATE NOCASE);",
+    "CREATE INDEX spacecraft_leo_subgroups_parent ON spacecraft_leo_subgroups (parent);",
+    "CREATE INDEX spacecraft_leo_groupmembers_group ON spacecraft_leo_groupmembers (groupId, noradId);",
+    "CREATE INDEX spacecraft_leo_groupmembers_noradId ON spacecraft_leo_groupmembers (noradId);"
+]
+
+
+def copy_table(db, snapshot, table, epoch_id):
+    """
+    Copy the contents of one table from MySQL into the snapshot, in batches.
+
+    :param db:
+        A MySQLdb database connection
+    :param snapshot:
+        The sqlite3 connection to the snapshot being built
+    :param table:
+        The entry in <snapshot_tables> describing the table
+    :param epoch_id:
+        The database ID of the epoch whose elements are being published
+    :return:
+        Number of rows copied
+    """
+    column_names = [column[0] for column in table['columns']]
+    insert = "INSERT INTO {} ({}) VALUES ({});".format(table['name'], ", ".join(column_names),
+                                                       ", ".join(["?"] * len(column_names)))
+
+    cursor = server_side_cursor(db)
+    cursor.execute(table['query'], (epoch_id,) if "%s" in table['query'] else None)
+    row_count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        snapshot.executemany(insert, [tuple(row[name] for name in column_names) for row in rows])
+        row_count += len(rows)
+    cursor.close()
+    return row_count
+
+
+def build_snapshot(logger, epoch_id, path=snapshot_path):
+    """
+    Build a snapshot of the spacecraft catalogue and the orbital elements at a particular epoch, and atomically
+    replace any previous snapshot with it.
+
+    :param logger:
+        A logging object
+    :param epoch_id:
+        The database ID of the epoch whose elements should be published
+    :param path:
+        The path of the snapshot file to write
+    :return:
+        None
+    """
+    start_time = time.time()
+    [db, c] = shared_connection()
+    c.execute("SELECT epoch FROM spacecraft_epochs WHERE uid=%s;", (epoch_id,))
+    result = c.fetchall()
+    if not result:
+        logger.info("Cannot publish snapshot of epoch {:d}, which does not exist".format(epoch_id))
+        return
+    epoch = result[0]['epoch']
+
+    # Build the new snapshot in a temporary file. It is not visible to readers until it is complete, so we need no
+    # journal, and do not need to sync the file until the end.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.tmp".format(path)
+    for tmp_file in [tmp_path, "{}-journal".format(tmp_path)]:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    snapshot = sqlite3.connect(tmp_path, isolation_level=None)
+    snapshot.execute("PRAGMA journal_mode=OFF;")
+    snapshot.execute("PRAGMA synchronous=OFF;")
+    snapshot.execute("BEGIN;")
+
+    # Create the tables, and fill them in primary key order
+    for table in snapshot_tables:
+        snapshot.execute("CREATE TABLE {} ({});".format(table['name'], ", ".join(
+            "{} {}".format(name, definition) for [name, definition] in table['columns'])))
+        if table['query'] is not None:
+            row_count = copy_table(db=db, snapshot=snapshot, table=table, epoch_id=epoch_id)
+            logger.info("Copied {:d} rows of <{}> into snapshot".format(row_count, table['name']))
+
+    snapshot.execute("INSERT INTO snapshot_info (epochId, epoch, created) VALUES (?, ?, ?);",
+                     (epoch_id, epoch, time.time()))
+
+    # Create the indexes once the tables are full, which is much faster than updating them row by row
+    for index in snapshot_indexes:
+        snapshot.execute(index)
+    snapshot.execute("COMMIT;")
+    snapshot.execute("ANALYZE;")
+    snapshot.close()
+
+    # Make sure the new file is on disk, then swap it into place
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    logger.info("Published snapshot of epoch {:d} ({:.1f} MB) in {:.1f} sec".
+                format(epoch_id, os.path.getsize(path) / 1e6, time.time() - start_time))
+
+
+def open_snapshot(path=snapshot_path):
+    """
+    Open the published snapshot for reading. The file is opened read-only and treated as immutable, so SQLite takes
+    no locks on it, and it is memory-mapped. Rows are returned as sqlite3.Row objects, which can be indexed by
+    column name.
+
+    :param path:
+        The path of the snapshot file
+    :return:
+        sqlite3 connection
+    """
+    snapshot = sqlite3.connect("file:{}?mode=ro&immutable=1".format(os.path.abspath(path)), uri=True,
+                               check_same_thread=False)
+    snapshot.row_factory = sqlite3.Row
+    snapshot.execute("PRAGMA mmap_size={:d};".format(mmap_size))
+    return snapshot
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        stream=sys.stdout,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--epoch', dest='epoch_id', type=int, default=None,
+                        help="ID of the epoch to publish (default: the latest epoch)")
+    parser.add_argument('--output', dest='output', default=snapshot_path,
+                        help="Path of the snapshot file to write")
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+
+    epoch_id = args.epoch_id
+    if epoch_id is None:
+        [db, c] = shared_connection()
+        c.execute("SELECT uid FROM spacecraft_epochs ORDER BY epoch DESC LIMIT 1;")
+        result = c.fetchall()
+        epoch_id = result[0]['uid'] if result else None
+
+    if epoch_id is not None:
+        build_snapshot(logger=logger, epoch_id=epoch_id, path=args.output)
+
+    close_shared_connection()
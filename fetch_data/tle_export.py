@@ -0,0 +1,434 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# tle_export.py
+
+"""
+Render the orbital elements held in the database back into two-line element (TLE) text files, one for each subgroup
+of spacecraft plus one for the full catalogue, so that requests for "all the Starlink TLEs" can be served as a static
+file read.
+
+Files are written into a directory for each epoch, <../auto/tle_export/epoch_NNNNN>, in both plain and
+gzip-compressed form. Each of these is a symlink to a uniquely named directory, which is swapped atomically when an
+epoch is rendered again. The symlink <../auto/tle_export/latest> points to the most recent epoch. Files for historical
+epochs are rendered on demand, and a limited number of historical epochs are kept, discarding the least recently used.
+
+Group memberships are not recorded historically, so files for past epochs list the current members of each group.
+"""
+
+import argparse
+import calendar
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import sys
+import time
+
+from connect_db import shared_connection, close_shared_connection, server_side_cursor
+from tle_parser import tle_checksum, LINE2_FORMAT
+
+# Directory into which we export TLE files
+export_path = "../auto/tle_export"
+
+# Name of the file containing the full catalogue
+catalogue_name = "catalogue"
+
+# Directories of TLE files older than this many seconds which no epoch symlink points to are abandoned renders
+abandoned_render_age = 3600
+
+# Epochs used within this many seconds are never evicted, so that a path returned by <get_tle_file> can still be
+# opened after another thread or process has evicted epochs
+eviction_grace_period = 60
+
+
+def format_exponential(value):
+    """
+    Format a number in the TLE's implied-decimal exponential notation, e.g. -0.12345E-3 becomes "-12345-3".
+
+    :param value:
+        The number to format
+    :return:
+        8-character string
+    """
+    if value is None or value == 0:
+        return " 00000-0"
+
+    sign = "-" if value < 0 else " "
+    exponent = int(math.floor(math.log10(abs(value)))) + 1
+    mantissa = int(round(abs(value) / 10 ** exponent * 1e5))
+    if mantissa >= 100000:
+        mantissa //= 10
+        exponent += 1
+
+    # Values too small to represent are rounded to zero; values too large are clipped
+    if exponent < -9:
+        return " 00000-0"
+    if exponent > 9:
+        mantissa, exponent = 99999, 9
+    return "{}{:05d}{}{:d}".format(sign, mantissa, "-" if exponent < 0 else "+", abs(exponent))
+
+
+def format_international_designator(cospar_id):
+    """
+    Convert a COSPAR ID, e.g. "1998-067A", into the international designator used in TLEs, e.g. "98067A  ".
+
+    :param cospar_id:
+        COSPAR ID string, or None
+    :return:
+        8-character string
+    """
+    test = re.match(r"\d\d(\d\d)-(\d\d\d)([A-Z]*)", cospar_id or "")
+    if not test:
+        return " " * 8
+    return "{}{}{:3s}".format(test.group(1), test.group(2), test.group(3)[:3])
+
+
+def format_epoch(epoch):
+    """
+    Format a unix time as a TLE epoch, "YYDDD.DDDDDDDD".
+
+    :param epoch:
+        Unix time
+    :return:
+        14-character string
+    """
+    year = time.gmtime(epoch).tm_year
+    day = (epoch - calendar.timegm((year, 1, 1, 0, 0, 0, 0, 0, 0))) / 86400 + 1  # January 1st is day 1
+    return "{:02d}{:012.8f}".format(year % 100, day)
+
+
+def render_tle(orbit, name=None):
+    """
+    Render a set of orbital elements as TLE text. This is the inverse of <tle_parser.parse_tle_lines>.
+
+    :param orbit:
+        Dictionary containing the columns of a row of the spacecraft_orbits table, plus the spacecraft's cosparId
+    :param name:
+        Optional name of the spacecraft, to be written on a line before the TLE
+    :return:
+        String containing two (or three) lines of text
+    """
+    mean_motion_dot = (orbit['meanMotionDot'] or 0) / 2
+    line1 = "1 {:05d}U {} {} {}.{:08d} {} {} 0  999".format(
+        orbit['noradId'],
+        format_international_designator(orbit['cosparId']),
+        format_epoch(orbit['epoch']),
+        "-" if mean_motion_dot < 0 else " ",
+        min(int(round(abs(mean_motion_dot) * 1e8)), 99999999),
+        format_exponential((orbit['meanMotionDotDot'] or 0) / 6),
+        format_exponential(orbit['bStar'] or 0))
+
+    line2 = LINE2_FORMAT.format(
+        orbit['noradId'],
+        orbit['incl'],
+        orbit['RAasc'],
+        min(int(round(orbit['ecc'] * 1e7)), 9999999),
+        orbit['argPeri'],
+        orbit['meanAnom'],
+        orbit['meanMotion'],
+        int(orbit['revCount'] or 0) % 100000)
+
+    text = "{}{:d}\n{}{:d}\n".format(line1, tle_checksum(line1), line2, tle_checksum(line2))
+    if name is not None:
+        text = "{:24s}\n".format(name[:24]) + text
+    return text
+
+
+def subgroup_filename(subgroup_name):
+    """
+    Convert the name of a subgroup of spacecraft into a filename.
+
+    :param subgroup_name:
+        The name of the subgroup, e.g. "Space Stations"
+    :return:
+        Filename stem, e.g. "space-stations"
+    """
+    return re.sub(r"[^a-z0-9]+", "-", subgroup_name.lower()).strip("-")
+
+
+def write_atomically(path, data):
+    """
+    Write a file, and a gzip-compressed copy of it with the suffix .gz. Each is written to a temporary file which is
+    then renamed, so readers never see a partially-written file.
+
+    :param path:
+        The path of the file to write
+    :param data:
+        Bytes object containing the contents of the file
+    :return:
+        None
+    """
+    for [output_path, output_data] in [[path, data],
+                                       ["{}.gz".format(path), gzip.compress(data, compresslevel=9)]]:
+        tmp_path = "{}.tmp".format(output_path)
+        with open(tmp_path, "wb") as f:
+            f.write(output_data)
+        os.replace(tmp_path, output_path)
+
+
+def replace_symlink(link_path, target):
+    """
+    Atomically create or replace a symlink, by creating a new one and renaming it over the old one.
+
+    :param link_path:
+        The path of the symlink
+    :param target:
+        The path the symlink should point to, relative to the directory containing it
+    :return:
+        None
+    """
+    tmp_link = "{}.tmp".format(link_path)
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link_path)
+
+
+def epoch_directory(epoch_id):
+    """
+    Return the directory into which TLE files for an epoch are exported. This is a symlink to the directory in which
+    the epoch was most recently rendered.
+
+    :param epoch_id:
+        The database ID of the epoch
+    :return:
+        Path of directory
+    """
+    return os.path.join(export_path, "epoch_{:06d}".format(epoch_id))
+
+
+def render_epoch(logger, epoch_id, db=None, c=None):
+    """
+    Render the TLE files for every subgroup of spacecraft, and the full catalogue, at a particular epoch.
+
+    :param logger:
+        A logging object
+    :param epoch_id:
+        The database ID of the epoch
+    :param db:
+        A MySQLdb database handle, or None to use the connection shared by this process
+    :param c:
+        A MySQLdb database connection handle, or None to use the connection shared by this process
+    :return:
+        Path of the directory containing the files, or None if this epoch does not exist
+    """
+    if c is None:
+        [db, c] = shared_connection()
+    c.execute("SELECT epoch FROM spacecraft_epochs WHERE uid=%s;", (epoch_id,))
+    result = c.fetchall()
+    if not result:
+        return None
+    epoch = result[0]['epoch']
+
+    # Look up the current members of each subgroup
+    c.execute("SELECT s.uid, s.name AS subgroupname, g.name AS groupname FROM spacecraft_leo_subgroups s "
+              "INNER JOIN spacecraft_leo_groups g ON s.parent=g.uid;")
+    subgroups = c.fetchall()
+    c.execute("SELECT noradId, groupId FROM spacecraft_leo_groupmembers;")
+    members = {}
+    for item in c.fetchall():
+        members.setdefault(item['groupId'], set()).add(item['noradId'])
+
+    # Render the TLE of every spacecraft at this epoch
+    cursor = server_side_cursor(db)
+    cursor.execute("""
+SELECT o.noradId, s.cosparId, o.epoch, o.incl, o.ecc, o.RAasc, o.argPeri, o.meanAnom, o.meanMotion,
+       o.meanMotionDot, o.meanMotionDotDot, o.bStar, o.revCount,
+       (SELECT n.name FROM spacecraft_names n WHERE n.noradId=o.noradId AND n.primaryName LIMIT 1) AS name
+FROM spacecraft_orbit_epochs oe
+INNER JOIN spacecraft_orbits o ON o.uid=oe.orbitId
+INNER JOIN spacecraft s ON s.noradId=oe.noradId
+WHERE oe.epochId=%s AND oe.noradId<100000
+ORDER BY oe.noradId;
+""", (epoch_id,))
+    tles = [[orbit['noradId'], render_tle(orbit=orbit, name=orbit['name'] or "{:d}".format(orbit['noradId']))]
+            for orbit in cursor]
+    cursor.close()
+
+    # Build the files in a new, uniquely named directory
+    output_dir = epoch_directory(epoch_id)
+    tmp_dir = "{}.{:d}.{:d}".format(output_dir, os.getpid(), time.time_ns())
+    os.makedirs(tmp_dir)
+
+    index = {'epochId': epoch_id, 'epoch': epoch, 'files': []}
+    write_atomically(os.path.join(tmp_dir, "{}.tle".format(catalogue_name)),
+                     "".join(tle for [norad_id, tle] in tles).encode('utf-8'))
+    index['files'].append({'file': "{}.tle".format(catalogue_name), 'group': None, 'subgroup': None,
+                           'count': len(tles)})
+
+    for subgroup in subgroups:
+        subgroup_members = members.get(subgroup['uid'], set())
+        group_tles = [tle for [norad_id, tle] in tles if norad_id in subgroup_members]
+        filename = "{}.tle".format(subgroup_filename(subgroup['subgroupname']))
+        write_atomically(os.path.join(tmp_dir, filename), "".join(group_tles).encode('utf-8'))
+        index['files'].append({'file': filename, 'group': subgroup['groupname'],
+                               'subgroup': subgroup['subgroupname'], 'count': len(group_tles)})
+
+    write_atomically(os.path.join(tmp_dir, "index.json"), json.dumps(index, indent=1).encode('utf-8'))
+
+    # Point the symlink for this epoch at the new directory, so readers never see a missing or partial set of files,
+    # and then delete any previous rendering of this epoch
+    previous_dir = None
+    if os.path.islink(output_dir):
+        previous_dir = os.path.join(export_path, os.readlink(output_dir))
+    elif os.path.isdir(output_dir):
+        # Directory written before epochs were symlinked
+        shutil.rmtree(output_dir)
+    replace_symlink(link_path=output_dir, target=os.path.basename(tmp_dir))
+    if previous_dir is not None:
+        shutil.rmtree(previous_dir, ignore_errors=True)
+
+    logger.info("Exported TLEs for {:d} spacecraft in {:d} subgroups at epoch {:d}".
+                format(len(tles), len(subgroups), epoch_id))
+    return output_dir
+
+
+def export_latest(logger, epoch_id, max_cached_epochs=20):
+    """
+    Render the TLE files for a newly committed epoch, and point the <latest> symlink at them. This is called by
+    <main_spacecraft> after each new epoch is committed.
+
+    :param logger:
+        A logging object
+    :param epoch_id:
+        The database ID of the new epoch
+    :param max_cached_epochs:
+        The maximum number of historical epochs to keep, including those which were previously the latest
+    :return:
+        None
+    """
+    os.makedirs(export_path, exist_ok=True)
+    output_dir = render_epoch(logger=logger, epoch_id=epoch_id)
+    if output_dir is None:
+        return
+
+    replace_symlink(link_path=os.path.join(export_path, "latest"), target=os.path.basename(output_dir))
+
+    # Delete old epochs, which would otherwise accumulate after every fetch
+    evict_epochs(max_cached_epochs=max_cached_epochs)
+
+
+def latest_epoch_id():
+    """
+    Return the ID of the epoch that the <latest> symlink points to.
+
+    :return:
+        The database ID of the epoch, or None
+    """
+    link_path = os.path.join(export_path, "latest")
+    if not os.path.lexists(link_path):
+        return None
+    test = re.match(r"epoch_(\d+)$", os.readlink(link_path))
+    return int(test.group(1)) if test else None
+
+
+def evict_epochs(max_cached_epochs):
+    """
+    Delete the least recently used directories of TLE files for historical epochs, keeping at most
+    <max_cached_epochs> of them. The directory for the latest epoch, and those used within the last
+    <eviction_grace_period> seconds, are never deleted, so the number of epochs kept may briefly exceed the limit. Also
+    delete directories left behind by renders which did not complete.
+
+    :param max_cached_epochs:
+        The maximum number of historical epochs to keep
+    :return:
+        None
+    """
+    latest_id = latest_epoch_id()
+    cached = []
+    referenced = set()
+    for filename in os.listdir(export_path):
+        test = re.match(r"epoch_(\d+)$", filename)
+        path = os.path.join(export_path, filename)
+        if not test:
+            continue
+        if os.path.islink(path):
+            referenced.add(os.readlink(path))
+        if int(test.group(1)) != latest_id:
+            cached.append([os.path.getmtime(path), path])
+
+    cached.sort()
+    for [mtime, path] in cached[:max(0, len(cached) - max_cached_epochs)]:
+        if mtime > time.time() - eviction_grace_period:
+            break
+        if os.path.islink(path):
+            target = os.path.join(export_path, os.readlink(path))
+            os.remove(path)
+            shutil.rmtree(target, ignore_errors=True)
+        else:
+            # Directory written before epochs were symlinked
+            shutil.rmtree(path, ignore_errors=True)
+
+    # Renders which are still in progress, possibly in another process, are not yet referenced by a symlink, so only
+    # delete unreferenced directories once they are old
+    for filename in os.listdir(export_path):
+        path = os.path.join(export_path, filename)
+        if (re.match(r"epoch_\d+\.\d+\.\d+$", filename) and filename not in referenced and
+                os.path.getmtime(path) < time.time() - abandoned_render_age):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def get_tle_file(logger, epoch_id, filename, max_cached_epochs=20, db=None, c=None):
+    """
+    Return the path of an exported TLE file for an epoch, rendering the epoch if it has not been rendered already.
+
+    :param logger:
+        A logging object
+    :param epoch_id:
+        The database ID of the epoch
+    :param filename:
+        The name of the file, e.g. "starlink.tle", or "starlink.tle.gz" for the compressed copy
+    :param max_cached_epochs:
+        The maximum number of historical epochs to keep
+    :param db:
+        A MySQLdb database handle to use if the epoch needs rendering, or None to use the connection shared by this
+        process
+    :param c:
+        A MySQLdb database connection handle to use if the epoch needs rendering, or None to use the connection shared
+        by this process
+    :return:
+        Path of the file, or None if it does not exist
+    """
+    output_dir = epoch_directory(epoch_id)
+    try:
+        # Mark this epoch as recently used
+        os.utime(output_dir)
+    except FileNotFoundError:
+        os.makedirs(export_path, exist_ok=True)
+        output_dir = render_epoch(logger=logger, epoch_id=epoch_id, db=db, c=c)
+        evict_epochs(max_cached_epochs=max_cached_epochs)
+        if output_dir is None:
+            return None
+
+    path = os.path.join(output_dir, os.path.basename(filename))
+    return path if os.path.exists(path) else None
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        stream=sys.stdout,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--epoch', dest='epoch_id', type=int, default=None,
+                        help="ID of the epoch to render (default: the latest epoch)")
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+
+    if args.epoch_id is None:
+        [db, c] = shared_connection()
+        c.execute("SELECT uid FROM spacecraft_epochs ORDER BY epoch DESC LIMIT 1;")
+        result = c.fetchall()
+        if result:
+            export_latest(logger=logger, epoch_id=result[0]['uid'])
+    else:
+        get_tle_file(logger=logger, epoch_id=args.epoch_id, filename="index.json")
+
+    close_shared_connection()
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+# tle_parser.py
+
+"""
+Functions for parsing two-line element (TLE) files, either serially or by spreading files -- and chunks of large
+files -- across a pool of worker processes.
+"""
+
+import array
+import calendar
+import gzip
+import io
+import math
+import multiprocessing
+import os
+
+# Number of numeric fields stored for each set of orbital elements when they are packed into a flat array of doubles.
+# These are: noradId, epoch, incl, ecc, RAasc, argPeri, meanAnom, meanMotion, mag, meanMotionDot, meanMotionDotDot,
+# bStar, revCount
+RECORD_LENGTH = 13
+
+# Files larger than this many bytes are split into chunks which are parsed by separate worker processes
+DEFAULT_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Dictionary of spacecraft magnitudes, shared with each worker process once when the pool is started
+_worker_sat_mags = {}
+
+# Format of the second line of a TLE, without its checksum: NORAD ID, inclination, right ascension of the ascending
+# node, eccentricity (as an integer with an implied leading decimal point), argument of perigee, mean anomaly, mean
+# motion and revolution count
+LINE2_FORMAT = "2 {:05d} {:8.4f} {:8.4f} {:07d} {:8.4f} {:8.4f} {:11.8f}{:5d}"
+
+
+def epoch_year(two_digit_year):
+    """
+    Convert the two-digit year of a TLE epoch into a four-digit year. By convention, years 57-99 are 1957-1999 and
+    years 00-56 are 2000-2056.
+
+    :param two_digit_year:
+        Integer two-digit year
+    :return:
+        Integer four-digit year
+    """
+    return 1900 + two_digit_year if two_digit_year >= 57 else 2000 + two_digit_year
+
+
+def tle_checksum(line):
+    """
+    Compute the modulo-10 checksum of a line of a TLE: the sum of its digits, with minus signs counting as 1.
+
+    :param line:
+        The first 68 characters of a line of a TLE
+    :return:
+        Integer checksum
+    """
+    return sum(int(ch) if ch.isdigit() else (1 if ch == "-" else 0) for ch in line[:68]) % 10
+
+
+# Unix time at the start of each year, indexed by the two-digit year in a TLE epoch. A file contains only a handful of
+# distinct years, so we look these up rather than calling calendar.timegm for every set of elements.
+_year_starts = [calendar.timegm((epoch_year(yy), 1, 1, 0, 0, 0, 0, 0, 0)) for yy in range(100)]
+
+
+def parse_tle_lines(lines, sat_mags, starlink):
+    """
+    Iterate over the sets of orbital elements in a list of lines of TLE text.
+
+    :param lines:
+        A list of the lines of text in a TLE file
+    :param sat_mags:
+        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID
+    :param starlink:
+        Boolean flag indicating whether these are Starlink satellites, which are assigned a standard magnitude
+    :return:
+        Yields tuples of (noradId, epoch, incl, ecc, RAasc, argPeri, meanAnom, meanMotion, mag, meanMotionDot,
+        meanMotionDotDot, bStar, revCount)
+    """
+
+    line_count = 0
+    line_total = len(lines)
+    year_starts = _year_starts
+
+    while line_count < line_total:
+        # First line of a set of TLEs must start with "1 ". Celestrak intersperse TLEs with names
+        line1 = lines[line_count]
+        if not line1.startswith("1 "):
+            line_count += 1
+            continue
+
+        line2 = lines[line_count + 1]
+        norad_id = int(line1[2: 7])
+        incl = float(line2[8:16])
+        ecc = float("0." + line2[26:33])
+        ra_asc = float(line2[17:25])
+        arg_peri = float(line2[34:42])
+        mean_anom = float(line2[43:51])
+        mean_motion = float(line2[52:63])
+
+        mean_motion_dot = ((-1 if line1[33] == "-" else 1) *
+                           float(line1[34:43]) * 2)
+
+        mean_motion_dot_dot = ((-1 if line1[44] == "-" else 1) *
+                               float("0." + line1[45:50] + "E" + line1[50:52]) * 6)
+
+        b_star = ((-1 if line1[53] == "-" else 1) *
+                  float("0." + line1[54:59] + "E" + line1[59:61]))
+
+        rev_count = float(line2[63:68])
+
+        epoch = year_starts[int(line1[18:20])] + (float(line1[20:32]) - 1) * 3600 * 24  # January 1st is day 1
+
+        if norad_id in sat_mags:
+            mag = sat_mags[norad_id]
+        elif starlink:
+            # Hard code a standard magnitude for all Starlink satellites!
+            mag = 5.5
+        else:
+            mag = None
+
+        yield (norad_id, epoch, incl, ecc, ra_asc, arg_peri, mean_anom, mean_motion, mag,
+               mean_motion_dot, mean_motion_dot_dot, b_star, rev_count)
+
+        line_count += 2
+
+
+def is_starlink_group(group):
+    """
+    Test whether a (sub)group of satellites is the Starlink constellation, which is assigned a standard magnitude.
+
+    :param group:
+        Dictionary describing the (sub)group of satellites contained within a TLE file, or None
+    :return:
+        Boolean
+    """
+    return bool(group) and group['subgroupname'] == 'Starlink'
+
+
+def make_item(group, record, source):
+    """
+    Convert a tuple of parsed orbital elements into the list structure used by <main_spacecraft>.
+
+    :param group:
+        The name of the (sub)group of satellites contained within this TLE file
+    :param record:
+        Tuple of orbital elements, as yielded by <parse_tle_lines>
+    :param source:
+        The source ID number for these orbital elements
+    :return:
+        List of [group, noradId, tuple of elements for insertion into the spacecraft_orbits table]
+    """
+    (norad_id, epoch, incl, ecc, ra_asc, arg_peri, mean_anom, mean_motion, mag,
+     mean_motion_dot, mean_motion_dot_dot, b_star, rev_count) = record
+
+    return [
+        group,
+        norad_id,
+        (norad_id, epoch, incl, ecc, ra_asc, arg_peri, mean_anom, mean_motion, mag,
+         mean_motion_dot, mean_motion_dot_dot, b_star, source, rev_count),
+    ]
+
+
+def read_tle_file(path, c, sat_mags, group, source):
+    """
+    Parse a two-line element (TLE) file and extract the list of orbital elements from it.
+
+    :param path:
+        The path of the TLE file we should parse
+    :param c:
+        A MySQLdb database connection handle
+    :param sat_mags:
+        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID
+    :param group:
+        The name of the (sub)group of satellites contained within this TLE file
+    :param source:
+        The source ID number for these orbital elements
+    :return:
+        A list of lists containing the orbital elements we extracted from the file
+    """
+
+    lines = open(path).readlines()
+    starlink = is_starlink_group(group)
+
+    return [make_item(group, record, source) for record in parse_tle_lines(lines, sat_mags, starlink)]
+
+
+def unpack_records(records, group, source):
+    """
+    Convert a flat array of orbital elements, as returned by a worker process, into the list structure returned by
+    <read_tle_file>.
+
+    :param records:
+        An array of doubles, containing RECORD_LENGTH values for each set of orbital elements
+    :param group:
+        The name of the (sub)group of satellites contained within this TLE file
+    :param source:
+        The source ID number for these orbital elements
+    :return:
+        A list of lists containing the orbital elements
+    """
+    items = []
+    for i in range(0, len(records), RECORD_LENGTH):
+        record = list(records[i:i + RECORD_LENGTH])
+
+        # NORAD IDs are integers; missing magnitudes are packed as NaN
+        record[0] = int(record[0])
+        if math.isnan(record[8]):
+            record[8] = None
+
+        items.append(make_item(group, record, source))
+    return items
+
+
+def chunk_offsets(path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Divide a TLE file into byte ranges of roughly <chunk_bytes> each. Each boundary falls at the start of the first
+    line of a set of TLEs, so that no set of elements is split between two chunks.
+
+    :param path:
+        The path of the TLE file we should divide
+    :param chunk_bytes:
+        The approximate size of each chunk, bytes
+    :return:
+        List of [start, end] byte offsets
+    """
+    file_size = os.path.getsize(path)
+    boundaries = [0]
+
+    with open(path, "rb") as f:
+        while boundaries[-1] + chunk_bytes < file_size:
+            # Jump forward by one chunk, and discard the (probably partial) line we land in
+            f.seek(boundaries[-1] + chunk_bytes)
+            f.readline()
+
+            # Look for the next line 1 of a TLE which is immediately followed by its line 2
+            boundary = None
+            while True:
+                position = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if line.startswith(b"1 "):
+                    next_line = f.readline()
+                    if next_line.startswith(b"2 "):
+                        boundary = position
+                        break
+                    f.seek(position + len(line))
+
+            if boundary is None:
+                break
+            boundaries.append(boundary)
+
+    boundaries.append(file_size)
+    return [[boundaries[i], boundaries[i + 1]] for i in range(len(boundaries) - 1)]
+
+
+def _init_worker(sat_mags):
+    """
+    Initialise a parser worker process, storing the dictionary of spacecraft magnitudes it should use.
+
+    :param sat_mags:
+        A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID
+    :return:
+        None
+    """
+    global _worker_sat_mags
+    _worker_sat_mags = sat_mags
+
+
+def _parse_chunk(task):
+    """
+    Parse a byte range of a TLE file within a worker process.
+
+    :param task:
+        List of [path, start offset, end offset, starlink flag]. Gzip-compressed files cannot be divided into byte
+        ranges, and are parsed whole; their offsets are ignored.
+    :return:
+        An array of doubles, containing RECORD_LENGTH values for each set of orbital elements
+    """
+    [path, start, end, starlink] = task
+
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+    else:
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+
+    # Decode the text in the same way as open(path).readlines(), with universal newlines
+    lines = io.TextIOWrapper(io.BytesIO(data)).readlines()
+
+    records = array.array('d')
+    for record in parse_tle_lines(lines, _worker_sat_mags, starlink):
+        if record[8] is None:
+            record = record[:8] + (math.nan,) + record[9:]
+        records.extend(record)
+    return records
+
+
+class PendingTleFile:
+    """
+    A TLE file which has been submitted to a ParallelTleReader, whose elements may not have been parsed yet.
+    """
+
+    def __init__(self, results, group, source):
+        self.results = results
+        self.group = group
+        self.source = source
+
+    def get(self):
+        """
+        Wait for all chunks of this file to be parsed.
+
+        :return:
+            A list of lists containing the orbital elements, identical to the output of <read_tle_file>
+        """
+        items = []
+        for result in self.results:
+            items.extend(unpack_records(result.get(), self.group, self.source))
+        return items
+
+
+class ParallelTleReader:
+    """
+    Parse TLE files in a pool of worker processes. Files are submitted as soon as they are available, and large files
+    are divided into chunks which are parsed concurrently. Gzip-compressed files (with the suffix .gz) are decompressed
+    and parsed whole by a single worker.
+    """
+
+    def __init__(self, sat_mags, processes=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+        """
+        Start a pool of parser processes.
+
+        :param sat_mags:
+            A dictionary of the absolute magnitudes of spacecraft, indexed by their NORAD ID
+        :param processes:
+            The number of worker processes to start. Defaults to the number of CPUs.
+        :param chunk_bytes:
+            The approximate size of the chunks into which large files are divided, bytes
+        """
+        self.chunk_bytes = chunk_bytes
+        self.pool = multiprocessing.Pool(processes=processes, initializer=_init_worker, initargs=(sat_mags,))
+
+    def submit(self, path, group, source):
+        """
+        Queue a TLE file to be parsed.
+
+        :param path:
+            The path of the TLE file we should parse
+        :param group:
+            The name of the (sub)group of satellites contained within this TLE file
+        :param source:
+            The source ID number for these orbital elements
+        :return:
+            A PendingTleFile object
+        """
+        starlink = is_starlink_group(group)
+        if path.endswith(".gz"):
+            chunks = [[0, None]]
+        else:
+            chunks = chunk_offsets(path, self.chunk_bytes)
+        results = [self.pool.apply_async(_parse_chunk, ([path, start, end, starlink],))
+                   for [start, end] in chunks]
+        return PendingTleFile(results=results, group=group, source=source)
+
+    def close(self):
+        """
+        Shut down the pool of worker processes.
+
+        :return:
+            None
+        """
+        self.pool.close()
+        self.pool.join()